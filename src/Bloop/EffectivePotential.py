@@ -1,10 +1,11 @@
 import numpy as np
 from scipy import linalg
 from numba import njit
-from itertools import chain
 import nlopt
 from dataclasses import dataclass, InitVar
 
+from .ParsedExpression import ComplexResultError
+
 @njit
 def diagonalizeNumba(matrices, matrixNumber, matrixSize, T):
     subEigenValues = np.empty((matrixNumber, matrixSize))
@@ -14,6 +15,80 @@ def diagonalizeNumba(matrices, matrixNumber, matrixSize, T):
     return subEigenValues * T**2, subRotationMatrix
 
 
+@njit(cache=True)
+def diagonalizeWarmNumba(matrices, previousRotationMatrix, T, tolerance, degeneracy, maxSweeps):
+    """diagonalizeNumba starting from the eigenvectors of a nearby point, each block
+    rotated into the previous eigen basis is almost diagonal so a few Jacobi sweeps
+    finish it. Falls back to eigh if the sweeps don't converge or for nearly
+    degenerate eigenvalues, whose eigenvectors jump between points. Pairs degenerate
+    to within the tolerance are kept, any basis of them is an eigen basis"""
+    matrixNumber, matrixSize = matrices.shape[0], matrices.shape[1]
+    subEigenValues = np.empty((matrixNumber, matrixSize))
+    subRotationMatrix = np.empty((matrixNumber, matrixSize, matrixSize))
+    matrix = np.empty((matrixSize, matrixSize))
+    for idx in range(matrixNumber):
+        rotation = previousRotationMatrix[idx].copy()
+        product = matrices[idx] @ rotation
+        normSquared = 0.0
+        for m in range(matrixSize):
+            for n in range(matrixSize):
+                entry = 0.0
+                for k in range(matrixSize):
+                    entry += rotation[k, m] * product[k, n]
+                matrix[m, n] = entry
+                normSquared += entry**2
+
+        ## Entries this small are left alone, all of them together are below tolerance
+        threshold = 0.1 * tolerance * np.sqrt(normSquared) / matrixSize
+        bConverged = False
+        for _ in range(maxSweeps):
+            offDiagonal = 0.0
+            for p in range(matrixSize - 1):
+                for q in range(p + 1, matrixSize):
+                    offDiagonal += 2 * matrix[p, q] ** 2
+            if offDiagonal <= tolerance**2 * normSquared:
+                bConverged = True
+                break
+
+            for p in range(matrixSize - 1):
+                for q in range(p + 1, matrixSize):
+                    if abs(matrix[p, q]) <= threshold:
+                        continue
+                    ## Rotation zeroing matrix[p, q] (Golub & Van Loan, sym.schur2)
+                    tau = (matrix[q, q] - matrix[p, p]) / (2 * matrix[p, q])
+                    t = (1.0 if tau >= 0 else -1.0) / (abs(tau) + np.sqrt(1 + tau**2))
+                    c = 1 / np.sqrt(1 + t**2)
+                    s = t * c
+                    for k in range(matrixSize):
+                        mkp, mkq = matrix[k, p], matrix[k, q]
+                        matrix[k, p], matrix[k, q] = c * mkp - s * mkq, s * mkp + c * mkq
+                    for k in range(matrixSize):
+                        mpk, mqk = matrix[p, k], matrix[q, k]
+                        matrix[p, k], matrix[q, k] = c * mpk - s * mqk, s * mpk + c * mqk
+                    for k in range(matrixSize):
+                        rkp, rkq = rotation[k, p], rotation[k, q]
+                        rotation[k, p], rotation[k, q] = c * rkp - s * rkq, s * rkp + c * rkq
+
+        ## Sorted ascending like eigh so the masses keep their order
+        eigenValues = np.diag(matrix).copy()
+        order = np.argsort(eigenValues)
+        norm = np.sqrt(normSquared)
+        bDegenerate = False
+        for m in range(matrixSize - 1):
+            gap = eigenValues[order[m + 1]] - eigenValues[order[m]]
+            if 100 * tolerance * norm < gap <= degeneracy * norm:
+                bDegenerate = True
+
+        if not bConverged or bDegenerate:
+            subEigenValues[idx], subRotationMatrix[idx] = np.linalg.eigh(matrices[idx])
+        else:
+            for m in range(matrixSize):
+                subEigenValues[idx, m] = eigenValues[order[m]]
+                for k in range(matrixSize):
+                    subRotationMatrix[idx, k, m] = rotation[k, order[m]]
+    return subEigenValues * T**2, subRotationMatrix
+
+
 @dataclass(frozen=True)
 class cNlopt:
     nbrVars: int = 0
@@ -23,6 +98,7 @@ class cNlopt:
     relLocalTol: float = 0
     absGlobalTol: float = 0
     relGlobalTol: float = 0
+    localMethod: str = "LN_BOBYQA"
     config: InitVar[dict] = None
 
     ##Regular init method doesn't work with frozen data classes,
@@ -41,7 +117,8 @@ class cNlopt:
         return self.nloptLocal(func, opt.optimize(initialGuess))
 
     def nloptLocal(self, func: callable, initialGuess: list[float]):
-        opt = nlopt.opt(nlopt.LN_BOBYQA, self.nbrVars)
+        ## LD_ methods need func to fill its grad argument
+        opt = nlopt.opt(getattr(nlopt, self.localMethod), self.nbrVars)
         opt.set_min_objective(func)
         opt.set_lower_bounds(self.varLowerBounds)
         opt.set_upper_bounds(self.varUpperBounds)
@@ -71,8 +148,26 @@ class EffectivePotential:
         scalarRotationMatrix,
         allSymbols,
         veffArray,
-        scalarMassNames
+        scalarMassNames,
+        bRealFastPath=False,
+        veffPartials=None,
+        vectorMassesJacobian=None,
+        scalarMassMatricesJacobian=None,
+        fieldIndependent=None,
+        bNewtonPolish=False,
+        compiledScalarEigenSystem=None,
+        compiledScalarMassMatrices=None,
+        bWarmStartEigen=False,
     ):
+        """veffPartials, vectorMassesJacobian and scalarMassMatricesJacobian are
+        needed for evaluatePotentialGradient, see PythoniseMathematica.pythoniseGradients.
+        fieldIndependent computes the coefficients hoisted out of the field
+        dependent systems, see PythoniseMathematica.hoistFieldIndependent.
+        compiledScalarEigenSystem (e.g. from the numba backend) builds and
+        diagonalises the scalar mass matrices from params in one call and
+        compiledScalarMassMatrices only builds them (divided by T^2).
+        bWarmStartEigen diagonalises starting from the eigenvectors of the
+        previous call, see diagonalizeWarmNumba"""
         self.fieldNames = fieldNames
 
         self.loopOrder = loopOrder
@@ -95,17 +190,98 @@ class EffectivePotential:
         self.veffArray = veffArray
         
         if not veffArray:
-            from .Veff import Veff
+            from .Veff import Veff, VeffBatch
             self.Veff = Veff
+            self.VeffBatch = VeffBatch
         
         self.scalarMassNames = scalarMassNames
-        
+        self.bRealFastPath = bRealFastPath
+        ## Number of real fast path evaluations that needed complex arithmetic
+        self.realFallbacks = 0
+
+        ## Where the fields, rotation matrix entries and scalar masses go in params
+        self.fieldIndices = np.array([allSymbols.index(name) for name in fieldNames])
+        self.rotationIndices = np.array(
+            [allSymbols.index(symbol) for symbol in scalarRotationMatrix], dtype=int
+        )
+        ## The rotation matrix entries are gathered straight from the eigenvectors of
+        ## each block with the permutation (if the user permutted the mass matrix in
+        ## DRalgo) folded in, entries between different blocks are zero
+        rows, columns = np.array(
+            list(scalarRotationMatrix.values()), dtype=int
+        ).reshape(-1, 2).T
+        if len(self.scalarPermutationMatrix) > 0:
+            blockSize = len(scalarMassNames) // len(scalarMassMatrices.indices)
+            rows = np.argmax(self.scalarPermutationMatrix[rows], axis=1)
+            self.rotationGather = (rows // blockSize, rows % blockSize, columns % blockSize)
+            self.bRotationInBlock = rows // blockSize == columns // blockSize
+        else:
+            self.rotationGather = (np.zeros_like(rows), rows, columns)
+            self.bRotationInBlock = np.ones(len(rows), dtype=bool)
+        self.scalarMassIndices = np.array(
+            [allSymbols.index(name) for name in scalarMassNames], dtype=int
+        )
+        ## Params of the point being evaluated, reused by every call so the vector
+        ## and scalar masses are written into it rather than into new arrays
+        self.paramsBuffer = np.empty(len(allSymbols), dtype=complex)
+        self.realParamsBuffer = np.empty(len(allSymbols))
+
+        self.veffPartials = veffPartials
+        self.vectorMassesJacobian = vectorMassesJacobian
+        self.scalarMassMatricesJacobian = scalarMassMatricesJacobian
+        self.fieldIndependent = fieldIndependent
+        self.bNewtonPolish = bNewtonPolish
+        self.compiledScalarEigenSystem = compiledScalarEigenSystem
+        self.compiledScalarMassMatrices = compiledScalarMassMatrices
+        self.bWarmStartEigen = bWarmStartEigen
+        ## Eigenvectors of the last diagonalisation (the warm start of the next) and
+        ## the Jacobi tolerance, relative gap treated as degenerate and max sweeps
+        self.previousRotationMatrix = None
+        self.warmStartSettings = (1e-12, 1e-6, 6)
+
+        if veffPartials:
+            ## Sort the partial derivatives by what they chain through
+            partialNames = [allSymbols[idx] for idx in veffPartials.indices]
+            vectorNames = [
+                allSymbols[idx]
+                for idx in vectorMassesJacobian.indices[:: len(fieldNames)]
+            ]
+
+            def partialIndices(names):
+                return np.array(
+                    [
+                        [partialIdx, list(names).index(name)]
+                        for partialIdx, name in enumerate(partialNames)
+                        if name in names
+                    ],
+                    dtype=int,
+                ).reshape(-1, 2).T
+
+            self.fieldPartials = partialIndices(fieldNames)
+            self.vectorPartials = partialIndices(vectorNames)
+            self.scalarMassPartials = partialIndices(scalarMassNames)
+            self.rotationPartials = partialIndices(list(scalarRotationMatrix))
+
+
     def findGlobalMinimum(self, T, params3D, minimumCandidates):
         """For physics reasons we only minimise the real part,
         for nlopt reasons we need to give a redunant grad arg"""
+        params3D = self.evaluateFieldIndependent(params3D)
+
+        ## The real fast path needs real inputs, if the matching gave complex
+        ## params we have to stay complex
+        bReal = self.bRealFastPath and not np.any(np.imag(params3D))
+        params3DObjective = np.real(params3D) if bReal else params3D
+        realFallbacks = self.realFallbacks
+
         def VeffWrapper(fields, grad):
+            if grad.size > 0:
+                veff, gradient = self.evaluatePotentialGradient(fields, T, params3D)
+                grad[:] = np.real(gradient)
+                return np.real(veff)
+
             return np.real(
-                    self.evaluatePotential(fields, T, params3D)
+                    self.evaluatePotential(fields, T, params3DObjective, bReal)
                 )
 
         bestResult = self.nloptInst.nloptGlobal(VeffWrapper, minimumCandidates[0])
@@ -115,66 +291,367 @@ class EffectivePotential:
             if result[1] < bestResult[1]:
                 bestResult = result
 
+        if self.bNewtonPolish:
+            bestResult = self.newtonPolish(bestResult[0], T, params3D)
+
+        if self.verbose and self.realFallbacks > realFallbacks:
+            print(
+                f"{self.realFallbacks - realFallbacks} real Veff evaluations at "
+                f"temp = {T} fell back to complex"
+            )
+
         ## Potential computed again in case its complex
         return bestResult[0], self.evaluatePotential(bestResult[0], T, params3D)
 
-    def evaluatePotential(self, fields, T, params3D):
-        paramsDict = self.computeMasses(fields, T, params3D)
-        params = [paramsDict[key] if key in paramsDict else 0 for key in self.allSymbols]
+    def newtonPolish(self, fields, T, params3D, maxSteps=5):
+        """Newton steps from the nlopt result, converges quadratically so a few
+        evaluations do what would take many more nlopt iterations. Fields held at
+        a bound by the gradient are kept fixed, stops if the (remaining) Hessian
+        isn't positive definite or a step raises Veff"""
+        lowerBounds = np.asarray(self.nloptInst.varLowerBounds, dtype=float)
+        upperBounds = np.asarray(self.nloptInst.varUpperBounds, dtype=float)
+        fields = np.clip(np.asarray(fields, dtype=float), lowerBounds, upperBounds)
+        veff, gradient = self.evaluatePotentialGradient(fields, T, params3D)
+
+        for _ in range(maxSteps):
+            gradient = np.real(gradient)
+            bFree = ~(
+                ((fields <= lowerBounds) & (gradient > 0))
+                | ((fields >= upperBounds) & (gradient < 0))
+            )
+            hessian = np.real(self.evaluatePotentialHessian(fields, T, params3D))
+
+            step = np.zeros_like(fields)
+            try:
+                step[bFree] = linalg.cho_solve(
+                    linalg.cho_factor(hessian[np.ix_(bFree, bFree)]), -gradient[bFree]
+                )
+            except linalg.LinAlgError:
+                break
+
+            newFields = np.clip(fields + step, lowerBounds, upperBounds)
+            newVeff, newGradient = self.evaluatePotentialGradient(newFields, T, params3D)
+            if np.real(newVeff) > np.real(veff):
+                break
+
+            fields, veff, gradient = newFields, newVeff, newGradient
+            if np.all(np.abs(step) <= self.nloptInst.absLocalTol):
+                break
+
+        return fields, np.real(veff)
+
+    def bIsStable(self, fields, T, params3D):
+        """Checks the Hessian is positive definite, i.e. fields is a minimum
+        rather than a saddle point or along a flat direction"""
+        params3D = self.evaluateFieldIndependent(params3D)
+        eigenValues = np.linalg.eigvalsh(
+            np.real(self.evaluatePotentialHessian(fields, T, params3D))
+        )
+
+        return bool(eigenValues[0] > 1e-6 * np.max(np.abs(eigenValues)))
+
+    def evaluatePotentialHessian(self, fields, T, params3D, stepSize=1e-3):
+        """Hessian of Veff w.r.t. the fields, by central differences of the analytic
+        gradient if it was generated otherwise second differences of Veff"""
+        fields = np.asarray(fields, dtype=float)
+        steps = stepSize * np.maximum(1, np.abs(fields))
+        shifts = np.diag(steps)
+
+        if self.veffPartials:
+            hessian = np.array(
+                [
+                    self.evaluatePotentialGradient(fields + shift, T, params3D)[1]
+                    - self.evaluatePotentialGradient(fields - shift, T, params3D)[1]
+                    for shift in shifts
+                ]
+            ) / (2 * steps[:, np.newaxis])
+
+            return (hessian + hessian.T) / 2
+
+        def veff(shift):
+            return self.evaluatePotential(fields + shift, T, params3D)
+
+        hessian = np.empty((len(fields), len(fields)), dtype=complex)
+        veffCentre = veff(0)
+        for i, j in zip(*np.triu_indices(len(fields))):
+            if i == j:
+                hessian[i, i] = (
+                    veff(shifts[i]) - 2 * veffCentre + veff(-shifts[i])
+                ) / steps[i] ** 2
+            else:
+                hessian[i, j] = hessian[j, i] = (
+                    veff(shifts[i] + shifts[j])
+                    - veff(shifts[i] - shifts[j])
+                    - veff(shifts[j] - shifts[i])
+                    + veff(-shifts[i] - shifts[j])
+                ) / (4 * steps[i] * steps[j])
+
+        return hessian
+
+    def evaluateFieldIndependent(self, params3D):
+        """Computes the coefficients that don't depend on the fields, needs to be
+        done (once) before evaluating the potential at a new temperature"""
+        if not self.fieldIndependent:
+            return params3D
+
+        ## The coefficients are indexed after the symbols the matching works with
+        params3D = np.pad(params3D, (0, len(self.allSymbols) - len(params3D)))
+        return self.fieldIndependent.evaluate(self.vectorShortHands.evaluate(params3D))
+
+    def evaluatePotential(self, fields, T, params3D, bReal=False):
+        if bReal:
+            try:
+                return self.evaluatePotentialReal(fields, T, params3D)
+            except ComplexResultError:
+                ## e.g. log or sqrt of a tachyonic mass, redo it in complex
+                self.realFallbacks += 1
+
+        params = self.computeMasses(fields, T, params3D)
 
         if self.veffArray:
             return sum(self.veffArray.evaluateUnordered(params))
         else:
-            return sum(self.Veff(*params))
+            return self.Veff(params)
 
-    def computeMasses(self, fields, T, params3D):
-        for i, value in enumerate(fields):
-            params3D[self.allSymbols.index(self.fieldNames[i])] = value
+    def evaluatePotentialBatch(self, paramsMatrix):
+        """Veff at each row of paramsMatrix, rows are params (masses included)
+        indexed like allSymbols. The cython kernel spreads rows over threads"""
+        if self.veffArray:
+            return np.sum(self.veffArray.evaluateUnorderedBatch(paramsMatrix), axis=1)
+        else:
+            return self.VeffBatch(paramsMatrix)
+
+    def evaluatePotentialGrid(self, fieldsArray, T, params3D):
+        """Veff at every point of fieldsArray (shape (..., len(fieldNames))), the
+        masses and diagonalisation of all points are done together in numpy.
+        params3D as for evaluatePotential, returns the real and imaginary parts
+        of Veff shaped like the points"""
+        fieldsArray = np.asarray(fieldsArray, dtype=float)
+        gridShape = fieldsArray.shape[:-1]
+
+        paramsMatrix = np.tile(
+            np.asarray(params3D, dtype=complex), (int(np.prod(gridShape)), 1)
+        )
+        paramsMatrix[:, self.fieldIndices] = fieldsArray.reshape(-1, len(self.fieldNames))
+        paramsMatrix = self.vectorMassesSquared.evaluateBatch(
+            self.vectorShortHands.evaluateBatch(paramsMatrix)
+        )
+
+        ## eigh diagonalises the stack of every block of every point at once
+        eigenValues, eigenVectors = np.linalg.eigh(
+            self.scalarMassMatrices.evaluateTensorBatch(paramsMatrix).real / T**2
+        )
+        paramsMatrix[:, self.rotationIndices] = np.where(
+            self.bRotationInBlock, eigenVectors[:, *self.rotationGather], 0
+        )
+        paramsMatrix[:, self.scalarMassIndices] = (
+            eigenValues.reshape(len(paramsMatrix), -1) * T**2
+        )
+
+        veff = np.asarray(self.evaluatePotentialBatch(paramsMatrix)).reshape(gridShape)
+        return veff.real, veff.imag
+
+    def evaluatePotentialReal(self, fields, T, params3D):
+        """float64 version of evaluatePotential, raises ComplexResultError when a
+        point needs complex arithmetic. params3D must be real"""
+        params = self.computeMasses(fields, T, params3D, bReal=True)
+
+        if self.veffArray:
+            ## Python floats so fractional powers of negative masses come out complex
+            return sum(self.veffArray.evaluateUnorderedReal(params.tolist()))
+        else:
+            return self.Veff(params)
+
+    def evaluatePotentialGradient(self, fields, T, params3D):
+        """Veff and its gradient w.r.t. the fields. The partial derivatives of Veff
+        are chained through the vector masses and the eigen system of the scalar
+        mass matrices, eigenvalues by Hellmann-Feynman and rotation matrices by
+        first order perturbation theory"""
+        params = self.computeVectorMasses(fields, params3D)
+        eigenValues, eigenVectors = self.scalarEigenSystem(params, T)
+        params = self.scalarEigenParams(params, eigenValues, eigenVectors)
+
+        if self.veffArray:
+            veff = sum(self.veffArray.evaluateUnordered(params))
+        else:
+            veff = self.Veff(params)
+
+        partials = np.array(self.veffPartials.evaluateUnordered(params), dtype=complex)
+        gradient = np.zeros(len(fields), dtype=complex)
+        np.add.at(gradient, self.fieldPartials[1], partials[self.fieldPartials[0]])
+
+        vectorJacobian = np.reshape(
+            self.vectorMassesJacobian.evaluateUnordered(params), (-1, len(fields))
+        )
+        gradient += partials[self.vectorPartials[0]] @ vectorJacobian[self.vectorPartials[1]]
+
+        ## d(mass matrix)/d(field) in the eigen basis, indexed [field, block, m, n]
+        massMatrixJacobian = np.array(
+            self.scalarMassMatricesJacobian.evaluateUnordered(params)
+        ).real
+        rotatedJacobian = np.einsum(
+            "bim,fbij,bjn->fbmn", eigenVectors, massMatrixJacobian, eigenVectors
+        )
+        eigenValueJacobian = np.diagonal(rotatedJacobian, axis1=2, axis2=3).reshape(
+            len(fields), -1
+        )
+        gradient += (
+            eigenValueJacobian[:, self.scalarMassPartials[1]]
+            @ partials[self.scalarMassPartials[0]]
+        )
+
+        if self.rotationPartials.size == 0:
+            return veff, gradient
+
+        ## Eigenvectors of (near) degenerate pairs aren't differentiable so they're
+        ## left out of the mixing, see degeneratePairsGradient
+        gaps = eigenValues[:, np.newaxis, :] - eigenValues[:, :, np.newaxis]
+        bDistinct = np.abs(gaps) > 1e-8 * np.max(np.abs(eigenValues))
+        mixing = np.divide(
+            rotatedJacobian, gaps, out=np.zeros_like(rotatedJacobian), where=bDistinct
+        )
+        eigenVectorJacobian = np.einsum("bim,fbmn->fbin", eigenVectors, mixing)
+
+        rotationJacobian = np.where(
+            self.bRotationInBlock, eigenVectorJacobian[:, *self.rotationGather], 0
+        )
+        gradient += (
+            rotationJacobian[:, self.rotationPartials[1]]
+            @ partials[self.rotationPartials[0]]
+        )
+
+        ## Only pairs the fields mix matter, e.g. not ones degenerate by symmetry
+        bMixed = np.max(np.abs(rotatedJacobian), axis=0) > 1e-10 * np.max(
+            np.abs(rotatedJacobian)
+        )
+        pairs = list(zip(*np.nonzero(np.triu(~bDistinct & bMixed, 1))))
+        if pairs:
+            gradient += self.degeneratePairsGradient(
+                params, partials, eigenValues, eigenVectors, rotatedJacobian, pairs
+            )
 
-        params3D = self.vectorShortHands.evaluate(params3D)
-        params3D = self.vectorMassesSquared.evaluate(params3D)
-        ## diagonalizeScalars doesn't take array (yet) so convert to dict
-        params3D = {key: value for (key, value) in zip(self.allSymbols, params3D)}
-        return self.diagonalizeScalars(params3D, T)
+        return veff, gradient
+
+    def degeneratePairsGradient(
+        self, params, partials, eigenValues, eigenVectors, rotatedJacobian, pairs
+    ):
+        """Gradient of Veff through the degenerate pairs (block, m, n) of eigenvalues.
+        Veff is invariant under rotating a degenerate pair, so its derivative w.r.t.
+        the off diagonal entry of the mass matrix (in the eigen basis) is the mass
+        partial with the pair rotated by 45 degrees less the mean of the pair's
+        partials. Each evaluation of the partials rotates pairs that don't share
+        an eigenvector"""
+        massPartials = self.scalarMassPartialsArray(partials, eigenValues.shape)
+        halfTurn = np.array([[1, -1], [1, 1]]) / np.sqrt(2)
+
+        gradient = np.zeros(rotatedJacobian.shape[0], dtype=complex)
+        while pairs:
+            matching, remaining, used = [], [], set()
+            for block, m, n in pairs:
+                if {(block, m), (block, n)} & used:
+                    remaining.append((block, m, n))
+                else:
+                    matching.append((block, m, n))
+                    used |= {(block, m), (block, n)}
+
+            rotated = eigenVectors.copy()
+            for block, m, n in matching:
+                rotated[block][:, [m, n]] = eigenVectors[block][:, [m, n]] @ halfTurn
+            rotatedPartials = np.array(
+                self.veffPartials.evaluateUnordered(
+                    self.scalarEigenParams(params.copy(), eigenValues, rotated)
+                ),
+                dtype=complex,
+            )
+            rotatedMassPartials = self.scalarMassPartialsArray(
+                rotatedPartials, eigenValues.shape
+            )
+
+            for block, m, n in matching:
+                offDiagonal = rotatedMassPartials[block, m] - (
+                    massPartials[block, m] + massPartials[block, n]
+                ) / 2
+                gradient += 2 * offDiagonal * rotatedJacobian[:, block, m, n]
+
+            pairs = remaining
+
+        return gradient
+
+    def scalarMassPartialsArray(self, partials, shape):
+        ## Partials w.r.t. the scalar masses, indexed like the eigenvalues
+        massPartials = np.zeros(len(self.scalarMassNames), dtype=complex)
+        massPartials[self.scalarMassPartials[1]] = partials[self.scalarMassPartials[0]]
+        return massPartials.reshape(shape)
+
+    def computeMasses(self, fields, T, params3D, bReal=False):
+        return self.diagonalizeScalars(
+            self.computeVectorMasses(fields, params3D, bReal), T
+        )
+
+    def computeVectorMasses(self, fields, params3D, bReal=False):
+        """A copy of params3D with the fields and vector masses filled in, params3D
+        itself is left as is. The copy is paramsBuffer (realParamsBuffer if bReal),
+        which the next call overwrites so callers mustn't keep it across calls"""
+        if bReal:
+            params = self.realParamsBuffer
+            params[:] = np.real(params3D)
+            params[self.fieldIndices] = fields
+            self.vectorShortHands.evaluateInPlaceReal(params)
+            return self.vectorMassesSquared.evaluateInPlaceReal(params)
+
+        params = self.paramsBuffer
+        params[:] = params3D
+        params[self.fieldIndices] = fields
+        self.vectorShortHands.evaluateInPlace(params)
+        return self.vectorMassesSquared.evaluateInPlace(params)
     
     def diagonalizeScalars(self, params3D, T):
         """Finds a rotation matrix that diagonalizes the scalar mass matrix
-        and returns a dict with diagonalization-specific params"""
-        subMassMatrix = np.array(self.scalarMassMatrices.evaluate(params3D)).real / T**2
+        and writes the diagonalization-specific params into params3D"""
+        return self.scalarEigenParams(params3D, *self.scalarEigenSystem(params3D, T))
 
-        subEigenValues, subRotationMatrix = diagonalizeNumba(
-            subMassMatrix, subMassMatrix.shape[0], subMassMatrix.shape[1], T
-        )
+    def scalarEigenSystem(self, params3D, T):
+        """Eigenvalues and eigenvectors of each block of the scalar mass matrix"""
+        if self.compiledScalarEigenSystem and not self.bWarmStartEigen:
+            return self.compiledScalarEigenSystem(params3D, T)
 
-        ## If the user permutted the mass matrix in DRalgo we have to unpermute it
-        if len(self.scalarPermutationMatrix) > 0:
-            subRotationMatrix = self.scalarPermutationMatrix @ linalg.block_diag(
-                *subRotationMatrix
-            )
+        if self.compiledScalarMassMatrices:
+            subMassMatrix = self.compiledScalarMassMatrices(params3D, T)
         else:
-            subRotationMatrix=subRotationMatrix[0]
-            
-        params3D |= {
-            symbol: subRotationMatrix[indices[0], indices[1]]
-            for symbol, indices in self.scalarRotationMatrix.items()
-        }
+            subMassMatrix = (
+                np.array(self.scalarMassMatrices.evaluateUnordered(params3D)).real / T**2
+            )
+
+        if not self.bWarmStartEigen:
+            return diagonalizeNumba(
+                subMassMatrix, subMassMatrix.shape[0], subMassMatrix.shape[1], T
+            )
+
+        ## Without a previous point no sweeps are done, i.e. straight to eigh
+        tolerance, degeneracy, maxSweeps = self.warmStartSettings
+        if self.previousRotationMatrix is None:
+            self.previousRotationMatrix, maxSweeps = np.zeros_like(subMassMatrix), 0
+
+        eigenValues, self.previousRotationMatrix = diagonalizeWarmNumba(
+            subMassMatrix, self.previousRotationMatrix, T, tolerance, degeneracy, maxSweeps
+        )
+        return eigenValues, self.previousRotationMatrix
+
+    def scalarEigenParams(self, params3D, subEigenValues, subRotationMatrix):
+        params3D[self.rotationIndices] = np.where(
+            self.bRotationInBlock, subRotationMatrix[self.rotationGather], 0
+        )
+        params3D[self.scalarMassIndices] = subEigenValues.ravel()
 
-        return params3D | {
-            name: float(msq) for name, msq in zip(self.scalarMassNames, chain(*subEigenValues))
-        }
+        return params3D
 
     ##Jasmine plotting tools
     def plotPot(self, T, params3D, linestyle, v3Min, potMin, v3Max):
-        def VeffWrapper(fields, grad):
-            return np.real(
-                    self.evaluatePotential(fields, T, params3D)
-                )
+        params3D = self.evaluateFieldIndependent(params3D)
 
         v3Range = np.linspace(1e-4, v3Max * 1.1, 80)
-        potArray = np.zeros(len(v3Range))
-        for idx, v3 in enumerate(v3Range):
-            potArray[idx] = VeffWrapper([1e-4, 1e-4, v3], 1)
-        potArray = potArray / T**3
+        fields = np.column_stack([np.full(80, 1e-4), np.full(80, 1e-4), v3Range])
+        potArray = self.evaluatePotentialGrid(fields, T, params3D)[0] / T**3
         import matplotlib.pylab as plt
 
         # plt.rcParams.update({'font.size': 12.5})
@@ -186,26 +663,20 @@ class EffectivePotential:
 
     def plotPot3D(self, T, params3D):
         import matplotlib.pyplot as plt
-        import numpy as np
 
         from matplotlib import cm
         from matplotlib.ticker import LinearLocator
 
-        def VeffWrapper(fields, grad):
-            return np.real(
-                    self.evaluatePotential(fields, T, params3D)
-                )
+        params3D = self.evaluateFieldIndependent(params3D)
+
         n = 100
         v3Range = np.linspace(-1.5, 13, n)
         v2Range = np.linspace(-1.5, 5, n)
         v2Mesh, v3Mesh = np.meshgrid(v2Range, v3Range)
-        potList = []
-        for v3 in v3Range:
-            for v2 in v2Range:
-                potList.append(VeffWrapper([v2, v2, v3], None))
-        minPot = min(potList)
-        potArray = np.array(potList).reshape(n, n)
-        potArray = (potArray - minPot) / T**3
+        potArray = self.evaluatePotentialGrid(
+            np.stack([v2Mesh, v2Mesh, v3Mesh], axis=-1), T, params3D
+        )[0]
+        potArray = (potArray - potArray.min()) / T**3
         fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
         zMax = 0.005
         ax.set_zlim(None, zMax)
@@ -229,3 +700,289 @@ class EffectivePotential:
 
         plt.show()
         return None
+
+
+from unittest import TestCase
+
+
+def toyEffectivePotential():
+    """Two fields, a vector mass and two 2x2 scalar mass blocks (permuted), with a
+    Veff that depends on the rotation matrix (invariantly under rotations of
+    degenerate eigenvectors) and the derivatives needed for its gradient"""
+    from .ParsedExpression import ParsedExpressionSystemArray, indexSymbols
+
+    rotationMatrix = {
+        "R1": [0, 2], "R2": [2, 2], "R3": [0, 3], "R4": [2, 3],
+        "R5": [1, 0], "R6": [3, 0], "R7": [1, 1], "R8": [3, 1],
+        ## Between blocks so always zero
+        "R9": [0, 0],
+    }
+    allSymbols = ["x", "y", "g", "mV", "M1", "M2", "M3", "M4", *rotationMatrix, "A", "B"]
+
+    def system(expressions):
+        return ParsedExpressionSystemArray(
+            indexSymbols(
+                [
+                    {"identifier": identifier, "expression": expression, "symbols": []}
+                    for identifier, expression in expressions
+                ],
+                allSymbols,
+            ),
+            allSymbols,
+            None,
+        )
+
+    veff = system([("A", term) for term in (
+        "g*mV**2 + x*y", "M1**2 + M2**2 + M3**3 + M4**3",
+        "R1**2*M3 + R3**2*M4 + R1*R2*M3 + R3*R4*M4",
+        "R5**2*M1 + R7**2*M2 + R5*R6*M1**2 + R7*R8*M2**2 + R9*M1",
+    )])
+    veffPartials = system([
+        ("x", "y"), ("y", "x"), ("mV", "2*g*mV"),
+        ("M1", "2*M1 + R5**2 + 2*R5*R6*M1 + R9"), ("M2", "2*M2 + R7**2 + 2*R7*R8*M2"),
+        ("M3", "3*M3**2 + R1**2 + R1*R2"), ("M4", "3*M4**2 + R3**2 + R3*R4"),
+        ("R1", "2*R1*M3 + R2*M3"), ("R2", "R1*M3"), ("R3", "2*R3*M4 + R4*M4"), ("R4", "R3*M4"),
+        ("R5", "2*R5*M1 + R6*M1**2"), ("R6", "R5*M1**2"),
+        ("R7", "2*R7*M2 + R8*M2**2"), ("R8", "R7*M2**2"), ("R9", "M1"),
+    ])
+    massMatrices = system([
+        ("A", "((x**2 + 1, x*y), (x*y, y**2 + 2))"),
+        ("B", "((x + 3, g*y), (g*y, 4 - x))"),
+    ])
+    ## Indexed [field, block, row, column]
+    massMatricesJacobian = system([
+        ("x", "(((2*x, y), (y, 0)), ((1, 0), (0, -1)))"),
+        ("y", "(((0, x), (x, 2*y)), ((0, g), (g, 0)))"),
+    ])
+
+    effectivePotential = EffectivePotential(
+        ["x", "y"],
+        2,
+        False,
+        None,
+        system([("mV", "g*x**2 + y**2")]),
+        system([]),
+        ## Rows of the block diagonal matrix 2, 0, 3, 1
+        [[0, 0, 1, 0], [1, 0, 0, 0], [0, 0, 0, 1], [0, 1, 0, 0]],
+        massMatrices,
+        rotationMatrix,
+        allSymbols,
+        veff,
+        ["M1", "M2", "M3", "M4"],
+        veffPartials=veffPartials,
+        vectorMassesJacobian=system([("mV", "2*g*x"), ("mV", "2*y")]),
+        scalarMassMatricesJacobian=massMatricesJacobian,
+    )
+    params3D = np.zeros(len(allSymbols), dtype=complex)
+    params3D[allSymbols.index("g")] = 0.7
+
+    return effectivePotential, params3D
+
+
+def quadraticEffectivePotential(curvature, lowerBounds=(-10, -10), bGradient=True):
+    """Veff = (x - 1)^2 + curvature*(y + 2)^2, a minimum at (1, -2) for positive
+    curvature and a saddle point for negative, with constant scalar masses"""
+    from types import SimpleNamespace
+    from .ParsedExpression import ParsedExpressionSystemArray, indexSymbols
+
+    allSymbols = ["x", "y", "mV", "M1", "M2", "R1", "A"]
+
+    def system(expressions):
+        return ParsedExpressionSystemArray(
+            indexSymbols(
+                [
+                    {"identifier": identifier, "expression": expression, "symbols": []}
+                    for identifier, expression in expressions
+                ],
+                allSymbols,
+            ),
+            allSymbols,
+            None,
+        )
+
+    effectivePotential = EffectivePotential(
+        ["x", "y"],
+        1,
+        False,
+        SimpleNamespace(varLowerBounds=lowerBounds, varUpperBounds=(10, 10), absLocalTol=1e-10),
+        system([("mV", "0")]),
+        system([]),
+        [],
+        system([("A", "((1, 0), (0, 2))")]),
+        {"R1": [0, 0]},
+        allSymbols,
+        system([("A", f"(x - 1)**2 + {curvature}*(y + 2)**2 + M1 + R1")]),
+        ["M1", "M2"],
+        veffPartials=system([
+            ("x", "2*(x - 1)"), ("y", f"2*{curvature}*(y + 2)"), ("M1", "1"), ("R1", "1"),
+        ]) if bGradient else None,
+        vectorMassesJacobian=system([("mV", "0"), ("mV", "0")]),
+        scalarMassMatricesJacobian=system([
+            ("x", "(((0, 0), (0, 0)),)"), ("y", "(((0, 0), (0, 0)),)"),
+        ]),
+    )
+
+    return effectivePotential, np.zeros(len(allSymbols), dtype=complex)
+
+
+class EffectivePotentialUnitTests(TestCase):
+    def test_evaluatePotentialParams(self):
+        effectivePotential, params3D = toyEffectivePotential()
+        reference = params3D.copy()
+
+        ## Both paths write into their own buffer, never the caller's params
+        veff = effectivePotential.evaluatePotential([0.3, -0.8], 1.0, params3D)
+        np.testing.assert_array_equal(reference, params3D)
+        veffReal = effectivePotential.evaluatePotential([0.3, -0.8], 1.0, params3D, bReal=True)
+        np.testing.assert_array_equal(reference, params3D)
+        self.assertAlmostEqual(veff, veffReal, places=12)
+
+    def test_evaluatePotentialRealFallback(self):
+        from .ParsedExpression import ParsedExpressionSystemArray
+
+        effectivePotential, params3D = quadraticEffectivePotential(1)
+        allSymbols = effectivePotential.allSymbols
+        effectivePotential.veffArray = ParsedExpressionSystemArray(
+            [{"identifier": "A", "expression": "sqrt(params[0]) + params[1]", "symbols": []}],
+            allSymbols,
+            None,
+        )
+
+        self.assertEqual(3, effectivePotential.evaluatePotential([4, 1], 1.0, params3D, True))
+        self.assertEqual(0, effectivePotential.realFallbacks)
+        ## A negative square root is redone in complex and counted
+        self.assertEqual(
+            1 + 2j, effectivePotential.evaluatePotential([-4, 1], 1.0, params3D, True)
+        )
+        self.assertEqual(1, effectivePotential.realFallbacks)
+
+    def test_evaluatePotentialGrid(self):
+        effectivePotential, params3D = toyEffectivePotential()
+        xMesh, yMesh = np.meshgrid(np.linspace(-0.9, 0.7, 4), np.linspace(-0.5, 1.1, 3))
+        fieldsArray = np.stack([xMesh, yMesh], axis=-1)
+
+        veffReal, veffImag = effectivePotential.evaluatePotentialGrid(fieldsArray, 1.0, params3D)
+        reference = [
+            [effectivePotential.evaluatePotential(fields, 1.0, params3D) for fields in row]
+            for row in fieldsArray
+        ]
+
+        self.assertEqual(xMesh.shape, veffReal.shape)
+        self.assertEqual(xMesh.shape, veffImag.shape)
+        np.testing.assert_allclose(veffReal + 1j * veffImag, reference, rtol=1e-12)
+
+    def test_evaluatePotentialHessian(self):
+        for bGradient in (True, False):
+            for curvature in (2, -3):
+                effectivePotential, params3D = quadraticEffectivePotential(
+                    curvature, bGradient=bGradient
+                )
+                np.testing.assert_allclose(
+                    np.real(effectivePotential.evaluatePotentialHessian([0.3, 0.4], 1.0, params3D)),
+                    [[2, 0], [0, 2 * curvature]],
+                    atol=1e-5,
+                )
+
+    def test_newtonPolish(self):
+        effectivePotential, params3D = quadraticEffectivePotential(2)
+        fields, veff = effectivePotential.newtonPolish([0.3, 0.4], 1.0, params3D)
+        np.testing.assert_allclose(fields, [1, -2], atol=1e-8)
+        self.assertAlmostEqual(2.0, veff)
+
+        ## x is held at its lower bound as the gradient pushes it out
+        effectivePotential, params3D = quadraticEffectivePotential(2, lowerBounds=(1.5, -10))
+        fields, _ = effectivePotential.newtonPolish([1.7, 0.4], 1.0, params3D)
+        np.testing.assert_allclose(fields, [1.5, -2], atol=1e-8)
+
+        ## No Newton step from a saddle point
+        effectivePotential, params3D = quadraticEffectivePotential(-3)
+        fields, _ = effectivePotential.newtonPolish([0.3, 0.4], 1.0, params3D)
+        np.testing.assert_allclose(fields, [0.3, 0.4])
+
+    def test_bIsStable(self):
+        for curvature, bStable in ((2, True), (-3, False), (0, False)):
+            effectivePotential, params3D = quadraticEffectivePotential(curvature)
+            self.assertEqual(bStable, effectivePotential.bIsStable([1, -2], 1.0, params3D))
+
+    def test_evaluatePotentialGradient(self):
+        effectivePotential, params3D = toyEffectivePotential()
+
+        def veff(fields):
+            return effectivePotential.evaluatePotential(fields, 1.0, params3D.copy())
+
+        ## A generic point and one where the second block is degenerate
+        for fields in ([0.3, -0.8], [0.5, 0.0]):
+            fields = np.array(fields)
+            value, gradient = effectivePotential.evaluatePotentialGradient(
+                fields, 1.0, params3D.copy()
+            )
+            steps = 1e-6 * np.eye(2)
+            reference = [(veff(fields + step) - veff(fields - step)) / 2e-6 for step in steps]
+
+            self.assertAlmostEqual(veff(fields), value, places=12)
+            np.testing.assert_allclose(gradient, reference, atol=1e-8)
+
+    def test_scalarEigenParams(self):
+        from scipy.linalg import block_diag
+        from .ParsedExpression import ParsedExpressionSystemArray, indexSymbols
+
+        ## Every entry of a 6x6 rotation matrix made of three 2x2 blocks, so most
+        ## are between blocks and have to be zero
+        rotationMatrix = {f"R{row}{column}": [row, column] for row in range(6) for column in range(6)}
+        scalarMassNames = [f"M{idx}" for idx in range(6)]
+        allSymbols = ["x", *scalarMassNames, *rotationMatrix, "A", "B", "C"]
+        massMatrices = ParsedExpressionSystemArray(
+            indexSymbols(
+                [
+                    {"identifier": identifier, "expression": "((x, 0), (0, x))", "symbols": []}
+                    for identifier in ("A", "B", "C")
+                ],
+                allSymbols,
+            ),
+            allSymbols,
+            None,
+        )
+        permutationMatrix = np.eye(6, dtype=int)[[4, 0, 2, 5, 1, 3]]
+        effectivePotential = EffectivePotential(
+            ["x"], 1, False, None, None, None, permutationMatrix, massMatrices,
+            rotationMatrix, allSymbols, massMatrices, scalarMassNames,
+        )
+
+        rng = np.random.default_rng(1)
+        blocks = np.linalg.qr(rng.normal(size=(3, 2, 2)))[0]
+        eigenValues = rng.normal(size=(3, 2))
+        params = effectivePotential.scalarEigenParams(
+            np.zeros(len(allSymbols)), eigenValues, blocks
+        )
+
+        reference = permutationMatrix @ block_diag(*blocks)
+        np.testing.assert_array_equal(
+            params[effectivePotential.rotationIndices],
+            [reference[row, column] for row, column in rotationMatrix.values()],
+        )
+        self.assertEqual(24, np.count_nonzero(params[effectivePotential.rotationIndices] == 0))
+        np.testing.assert_array_equal(
+            params[effectivePotential.scalarMassIndices], eigenValues.ravel()
+        )
+
+    def test_diagonalizeWarmNumba(self):
+        rng = np.random.default_rng(0)
+        matrices = rng.normal(size=(2, 4, 4))
+        matrices = matrices + matrices.transpose(0, 2, 1)
+        ## Exactly degenerate pair in the second block
+        matrices[1] = np.diag([1.0, 1.0, 2.0, 3.0])
+        _, previousRotationMatrix = np.linalg.eigh(matrices)
+
+        shifted = matrices + 1e-4 * (matrices[:, :, ::-1] + matrices[:, ::-1, :])
+        reference = np.linalg.eigvalsh(shifted) * 10.0**2
+        eigenValues, rotationMatrix = diagonalizeWarmNumba(
+            shifted, previousRotationMatrix, 10.0, 1e-12, 1e-6, 6
+        )
+
+        np.testing.assert_allclose(eigenValues, reference, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(
+            shifted @ rotationMatrix, rotationMatrix * eigenValues[:, np.newaxis, :] / 100, atol=1e-12
+        )
+        np.testing.assert_allclose(
+            rotationMatrix.transpose(0, 2, 1) @ rotationMatrix, np.eye(4)[np.newaxis].repeat(2, 0), atol=1e-12
+        )
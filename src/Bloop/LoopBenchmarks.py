@@ -7,12 +7,11 @@ from importlib import import_module
 
 from Bloop.TransitionFinder import TrackVEV
 from Bloop.EffectivePotential import EffectivePotential, cNlopt
+from Bloop.ModelFile import ModelFile
 from Bloop.ProcessMinimization import interpretData
-from Bloop.PythoniseMathematica import replaceGreekSymbols
-from Bloop.ParsedExpression import (
-    ParsedExpressionSystem,
-    ParsedExpressionSystemArray,
-)
+from Bloop.Profiler import Profiler
+from Bloop.PythoniseMathematica import pythoniseFunction, replaceGreekSymbols
+from Bloop.ParsedExpression import ParsedExpressionSystemArray, indexSymbols
 
 
 ## This (sometimes) avoids floating point error in T gotten by np.arange or linspace
@@ -36,11 +35,18 @@ def doBenchmark(trackVEV, args, benchmark, fieldNames):
         trackVEV.plotPotential(benchmark)
         exit()
         
+    trackVEV.profiler.reset()
     minimizationResult = trackVEV.trackVEV(benchmark)
 
     filename = f"{args.resultsDirectory}/BM_{benchmark['bmNumber']}"
 
     Path(args.resultsDirectory).mkdir(parents=True, exist_ok=True)
+    if args.bProfile:
+        if args.verbose:
+            print(f"Saving profile of {benchmark['bmNumber']} to {filename}_profile.json")
+        with open(f"{filename}_profile.json", "w") as fp:
+            fp.write(json.dumps(trackVEV.profiler.summary(), indent=4))
+
     if args.bSave:
         if args.verbose:
             print(f"Saving {benchmark['bmNumber']} to {filename}.json")
@@ -94,14 +100,85 @@ def loopBenchmarks(args):
 
 
 def setUpTrackVEV(args):
-    with open(args.pythonisedExpressionsFile, "r") as fp:
-        pythonisedExpressions = json.load(fp)
+    ## Sections are loaded on first use, so e.g. veffLO is never loaded here
+    pythonisedExpressions = ModelFile(args.pythonisedExpressionsFile)
 
     scalarRotationMatrix = pythonisedExpressions["scalarRotationMatrix"]["scalarRotationMatrix"]
     allSymbols = pythonisedExpressions["allSymbols"]["allSymbols"]
+    ## Coefficients hoisted out of the potential are indexed after allSymbols
+    potentialSymbols = allSymbols + [
+        expression["identifier"]
+        for expression in pythonisedExpressions.get("fieldIndependent", {}).get(
+            "expressions", []
+        )
+    ]
+
     lagranianVariables = pythonisedExpressions["lagranianVariables"]["lagranianVariables"]
     scalarMassNames = pythonisedExpressions["scalarMassNames"]["scalarMassNames"]
 
+    ## Compiled expressions are cached next to the pythonised file so later runs
+    ## (and pool workers) skip compiling
+    cacheDirectory = Path(args.pythonisedExpressionsFile).with_suffix(".codeCache")
+
+    if args.bNumba:
+        from Veff_generation import generate_numba_module, import_numba_module
+
+        pythonisedPath = Path(args.pythonisedExpressionsFile)
+        numbaModule = import_numba_module(
+            generate_numba_module(
+                pythonisedExpressions,
+                pythonisedPath.with_name(f"{pythonisedPath.stem}Numba.py"),
+                potentialSymbols,
+            )
+        )
+
+    if args.bCython:
+        ## Compiled with the Veff submodules when converting Mathematica
+        from Bloop.Veff import systems as cythonModule
+
+    def jitFunction(name):
+        if args.bNumba:
+            return getattr(numbaModule, name, None)
+        if args.bCython:
+            return getattr(cythonModule, name, None)
+        return None
+
+    ## Only instruments (wraps) methods if profiling is turned on
+    profiler = Profiler(args.bProfile)
+
+    def systemArray(name):
+        return profiler.instrument(
+            ParsedExpressionSystemArray(
+                pythonisedExpressions[name]["expressions"],
+                potentialSymbols,
+                pythonisedExpressions[name]["fileName"],
+                pythonisedExpressions[name].get("function"),
+                cacheDirectory,
+                jitFunction(name),
+            ),
+            name,
+            ("evaluate", "evaluateUnordered", "evaluateReal", "evaluateUnorderedReal"),
+        )
+
+    def matrixSystem(name):
+        ## The (nested tuple) matrix systems are pythonised with symbol names for the
+        ## benchmark generator, index them so they're evaluated from the params array
+        expressions = indexSymbols(
+            pythonisedExpressions[name]["expressions"], potentialSymbols
+        )
+        return profiler.instrument(
+            ParsedExpressionSystemArray(
+                expressions,
+                potentialSymbols,
+                pythonisedExpressions[name]["fileName"],
+                pythoniseFunction(name, expressions),
+                cacheDirectory,
+                getattr(cythonModule, name, None) if args.bCython else None,
+            ),
+            name,
+            ("evaluateUnordered",),
+        )
+
     nloptInst = cNlopt(
         config={
             "nbrVars": len(lagranianVariables["fieldSymbols"]),
@@ -111,42 +188,75 @@ def setUpTrackVEV(args):
             "relLocalTol": args.relLocalTolerance,
             "varLowerBounds": args.varLowerBounds,
             "varUpperBounds": args.varUpperBounds,
+            "localMethod": args.localMethod,
         }
     )
+    profiler.instrument(nloptInst, "nlopt", ("nloptGlobal", "nloptLocal"))
     
     if args.bCython:
         veffArray = None
     else:
-        veffArray = ParsedExpressionSystemArray(
-            pythonisedExpressions["veffArray"]["expressions"],
-            allSymbols,
-            pythonisedExpressions["veffArray"]["fileName"],
-        ) 
+        veffArray = systemArray("veffArray") 
+
+    ## Optional systems depending on how Mathematica was converted
+    optionalSystems = {}
+    if args.bNumba:
+        optionalSystems["compiledScalarEigenSystem"] = numbaModule.scalarEigenSystem
+        optionalSystems["compiledScalarMassMatrices"] = numbaModule.scaledScalarMassMatrices
+    if "fieldIndependent" in pythonisedExpressions:
+        optionalSystems["fieldIndependent"] = systemArray("fieldIndependent")
+
+    if args.localMethod.startswith("LD_") or args.bNewtonPolish:
+        if "veffPartials" not in pythonisedExpressions:
+            raise KeyError(
+                f"{args.pythonisedExpressionsFile} has no derivatives of Veff, rerun the "
+                "convertMathematica stage with the same --localMethod/--bNewtonPolish"
+            )
+
+        optionalSystems |= {
+            "veffPartials": systemArray("veffPartials"),
+            "vectorMassesJacobian": systemArray("vectorMassesJacobian"),
+            "scalarMassMatricesJacobian": matrixSystem("scalarMassMatricesJacobian"),
+        }
     
     effectivePotential = EffectivePotential(
         lagranianVariables["fieldSymbols"],
         args.loopOrder,
         args.verbose,
         nloptInst,
-        ParsedExpressionSystemArray(
-            pythonisedExpressions["vectorMassesSquared"]["expressions"],
-            allSymbols,
-            pythonisedExpressions["vectorMassesSquared"]["fileName"],
-        ),
-        ParsedExpressionSystemArray(
-            pythonisedExpressions["vectorShortHands"]["expressions"],
-            allSymbols,
-            pythonisedExpressions["vectorShortHands"]["fileName"],
-        ),
+        systemArray("vectorMassesSquared"),
+        systemArray("vectorShortHands"),
         pythonisedExpressions["scalarPermutationMatrix"],
-        ParsedExpressionSystem(
-            pythonisedExpressions["scalarMassMatrices"]["expressions"], 
-            pythonisedExpressions["scalarMassMatrices"]["fileName"],
+        ## With --bHoist the potential's mass matrices are in the hoisted coefficients
+        matrixSystem(
+            "hoistedScalarMassMatrices"
+            if "hoistedScalarMassMatrices" in pythonisedExpressions
+            else "scalarMassMatrices"
         ),
         scalarRotationMatrix,
-        allSymbols,
+        potentialSymbols,
         veffArray,
         scalarMassNames,
+        args.bRealFastPath,
+        bNewtonPolish=args.bNewtonPolish,
+        bWarmStartEigen=args.bWarmStartEigen,
+        **optionalSystems,
+    )
+    profiler.instrument(
+        effectivePotential,
+        "effectivePotential",
+        (
+            "findGlobalMinimum",
+            "evaluatePotential",
+            "evaluatePotentialReal",
+            "evaluatePotentialGradient",
+            "evaluatePotentialHessian",
+            "computeMasses",
+            "diagonalizeScalars",
+            "scalarEigenSystem",
+            "newtonPolish",
+            "bIsStable",
+        ),
     )
 
     fourPointSymbols = [
@@ -159,45 +269,27 @@ def setUpTrackVEV(args):
         replaceGreekSymbols(item) for item in lagranianVariables["gaugeSymbols"]
     ]
 
-    return (
-        TrackVEV(
-            config={
-                "effectivePotential": effectivePotential,
-                "hardToSoft": ParsedExpressionSystemArray(
-                    pythonisedExpressions["hardToSoft"]["expressions"],
-                    allSymbols,
-                    pythonisedExpressions["hardToSoft"]["fileName"],
-                ),
-                "softScaleRGE": ParsedExpressionSystemArray(
-                    pythonisedExpressions["softScaleRGE"]["expressions"],
-                    allSymbols,
-                    pythonisedExpressions["softScaleRGE"]["fileName"],
-                ),
-                "softToUltraSoft": ParsedExpressionSystemArray(
-                    pythonisedExpressions["softToUltraSoft"]["expressions"],
-                    allSymbols,
-                    pythonisedExpressions["softToUltraSoft"]["fileName"],
-                ),
-                "betaFunction4DExpression": ParsedExpressionSystemArray(
-                    pythonisedExpressions["betaFunctions4D"]["expressions"],
-                    allSymbols,
-                    pythonisedExpressions["betaFunctions4D"]["fileName"],
-                ),
-                "bounded": ParsedExpressionSystemArray(
-                    pythonisedExpressions["bounded"]["expressions"],
-                    allSymbols,
-                    pythonisedExpressions["bounded"]["fileName"],
-                ),
-                "TRange": tuple(
-                    _drange(args.TRangeStart, args.TRangeEnd, str(args.TRangeStepSize))
-                ),
-                "pertSymbols": frozenset(
-                    fourPointSymbols + yukawaSymbols + gaugeSymbols
-                ),
-                "verbose": args.verbose,
-                "initialGuesses": args.initialGuesses,
-                "allSymbols": allSymbols,
-            }
-        ),
-        lagranianVariables["fieldSymbols"],
+    trackVEV = TrackVEV(
+        config={
+            "effectivePotential": effectivePotential,
+            "hardToSoft": systemArray("hardToSoft"),
+            "softScaleRGE": systemArray("softScaleRGE"),
+            "softToUltraSoft": systemArray("softToUltraSoft"),
+            "betaFunction4DExpression": systemArray("betaFunctions4D"),
+            "bounded": systemArray("bounded"),
+            "TRange": tuple(
+                _drange(args.TRangeStart, args.TRangeEnd, str(args.TRangeStepSize))
+            ),
+            "pertSymbols": frozenset(
+                fourPointSymbols + yukawaSymbols + gaugeSymbols
+            ),
+            "verbose": args.verbose,
+            "bCheckStability": args.bCheckStability,
+            "initialGuesses": args.initialGuesses,
+            "allSymbols": allSymbols,
+            "profiler": profiler,
+        }
     )
+    pythonisedExpressions.close()
+
+    return trackVEV, lagranianVariables["fieldSymbols"]
@@ -0,0 +1,153 @@
+import json
+import mmap
+import os
+import struct
+from collections.abc import Mapping
+from pathlib import Path
+
+## Layout: magic, index length, index (json {section: [offset, length]} with offsets
+## from the end of the index) then each section as compact json
+magic = b"BLOOPMF\x01"
+indexLengthFormat = "<Q"
+
+
+def writeModelFile(sections, fileName):
+    """Write sections (the pythonised expressions) as a model file. Written to
+    a temporary file then moved so open (memory mapped) model files aren't truncated"""
+    payloads, index, offset = [], {}, 0
+    for name, section in sections.items():
+        payload = json.dumps(section, separators=(",", ":")).encode()
+        index[name] = [offset, len(payload)]
+        payloads.append(payload)
+        offset += len(payload)
+
+    indexBytes = json.dumps(index, separators=(",", ":")).encode()
+
+    (fileName := Path(fileName)).parent.mkdir(exist_ok=True, parents=True)
+    temporaryFile = fileName.with_name(f".{fileName.name}.tmp")
+    with open(temporaryFile, "wb") as fp:
+        fp.write(magic + struct.pack(indexLengthFormat, len(indexBytes)) + indexBytes)
+        for payload in payloads:
+            fp.write(payload)
+    os.replace(temporaryFile, fileName)
+
+
+class ModelFile(Mapping):
+    """Read only dict like view of a model file, sections are only decoded when
+    first accessed so a consumer only pays (time and memory) for what it uses.
+    Plain json files (the old pythonised expressions format) are loaded whole.
+    Sections already decoded stay available after close"""
+
+    def __init__(self, fileName):
+        self.sections, self.index, self.buffer = {}, {}, None
+        try:
+            with open(fileName, "rb") as fp:
+                if fp.read(len(magic)) != magic:
+                    fp.seek(0)
+                    self.sections = json.load(fp)
+                    return
+
+                self.buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+            (indexLength,) = struct.unpack_from(indexLengthFormat, self.buffer, len(magic))
+            indexStart = len(magic) + struct.calcsize(indexLengthFormat)
+            self.index = json.loads(self.buffer[indexStart : indexStart + indexLength])
+            self.dataStart = indexStart + indexLength
+            if self.dataStart + sum(length for _, length in self.index.values()) > len(self.buffer):
+                raise ValueError("sections run past the end of the file")
+        ## An empty file can't be memory mapped, a truncated one has a short index or sections
+        except (ValueError, struct.error) as error:
+            self.close()
+            raise ValueError(
+                f"{fileName} is empty or truncated ({error}), rerun the convertMathematica stage to regenerate it"
+            ) from error
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def __getitem__(self, name):
+        if name not in self.sections:
+            offset, length = self.index[name]
+            start = self.dataStart + offset
+            self.sections[name] = json.loads(self.buffer[start : start + length])
+
+        return self.sections[name]
+
+    def __iter__(self):
+        return iter(self.index or self.sections)
+
+    def __len__(self):
+        return len(self.index or self.sections)
+
+    def __contains__(self, name):
+        return name in self.index or name in self.sections
+
+
+from unittest import TestCase
+
+
+class ModelFileUnitTests(TestCase):
+    def test_ModelFile(self):
+        from tempfile import TemporaryDirectory
+
+        reference = {
+            "veff": {"expressions": [{"identifier": "a", "expression": "b"}]},
+            "scalarPermutationMatrix": [[1, 0], [0, 1]],
+        }
+
+        with TemporaryDirectory() as directory:
+            writeModelFile(reference, Path(directory) / "model.bin")
+            source = ModelFile(Path(directory) / "model.bin")
+
+            self.assertEqual({}, source.sections)
+            self.assertEqual(reference["veff"], source["veff"])
+            self.assertEqual(["veff"], list(source.sections))
+            self.assertEqual(reference, dict(source))
+            self.assertNotIn("veffArray", source)
+
+    def test_ModelFileJSON(self):
+        from tempfile import TemporaryDirectory
+
+        reference = {"veff": {"expressions": []}}
+
+        with TemporaryDirectory() as directory:
+            with open(Path(directory) / "model.json", "w") as fp:
+                json.dump(reference, fp)
+
+            self.assertEqual(reference, dict(ModelFile(Path(directory) / "model.json")))
+
+    def test_ModelFileTruncated(self):
+        from tempfile import TemporaryDirectory
+
+        reference = {"veffLO": {"expressions": [{"identifier": "a", "expression": "b"}]}}
+
+        with TemporaryDirectory() as directory:
+            writeModelFile(reference, Path(directory) / "model.bin")
+            contents = (Path(directory) / "model.bin").read_bytes()
+
+            for length in (0, len(magic) + 2, len(magic) + 12, len(contents) - 1):
+                (Path(directory) / "truncated.bin").write_bytes(contents[:length])
+                with self.assertRaisesRegex(ValueError, "rerun the convertMathematica"):
+                    ModelFile(Path(directory) / "truncated.bin")
+
+    def test_ModelFileClose(self):
+        from tempfile import TemporaryDirectory
+
+        reference = {"veffLO": {"expressions": []}, "allSymbols": {"allSymbols": ["a"]}}
+
+        with TemporaryDirectory() as directory:
+            writeModelFile(reference, Path(directory) / "model.bin")
+            with ModelFile(Path(directory) / "model.bin") as source:
+                self.assertEqual(reference["veffLO"], source["veffLO"])
+
+            self.assertIsNone(source.buffer)
+            self.assertEqual(reference["veffLO"], source["veffLO"])
+            source.close()
@@ -1,6 +1,31 @@
 from cmath import log, sqrt
+import math
+from hashlib import sha256
+from pathlib import Path
+import marshal
+import re
+import os
+import sys
 import numpy as np
 
+## Complex safe ufuncs used when evaluating many points at once,
+## min/max need replacing as the builtins don't broadcast
+batchFunctions = {
+    "log": np.log,
+    "sqrt": np.sqrt,
+    "min": np.minimum,
+    "max": np.maximum,
+}
+
+## Real versions raise ValueError for negative arguments, used to detect
+## when the real fast path has to fall back to complex arithmetic
+realFunctions = {"log": math.log, "sqrt": math.sqrt}
+
+
+class ComplexResultError(ArithmeticError):
+    """Raised by the real (float64) evaluations for a point that needs complex
+    arithmetic, i.e. a log or sqrt of a negative number or a complex result"""
+
 
 class ParsedExpression:
     def __init__(self, parsedExpression, fileName):
@@ -41,41 +66,230 @@ class ParsedExpressionSystem:
         return [expr.identifier for expr in self.parsedExpressions]
 
 
+## Names in an expression, numbers like 1e-05 don't match as there is no word boundary
+symbolPattern = re.compile(r"\b[^\W\d]\w*")
+
+
+def indexSymbols(parsedExpressionSystem, allSymbols):
+    """Swap the symbols of a system pythonised with symbol names (e.g. the scalar mass
+    matrices) for params[idx], so it can be evaluated like the array systems"""
+    indices = {symbol: idx for idx, symbol in enumerate(allSymbols)}
+
+    def index(match):
+        return f"params[{indices[match[0]]}]" if match[0] in indices else match[0]
+
+    return [
+        parsedExpression | {"expression": symbolPattern.sub(index, parsedExpression["expression"])}
+        for parsedExpression in parsedExpressionSystem
+    ]
+
+
+def compileCached(source, fileName, mode, cacheDirectory=None):
+    """compile() but with the code object marshalled to cacheDirectory.
+    Marshal isn't portable between python versions so the version is part
+    of the key along with everything that ends up in the code object"""
+    if not cacheDirectory:
+        return compile(source, fileName, mode)
+
+    key = sha256("\0".join((sys.version, fileName, mode, source)).encode()).hexdigest()
+    cacheFile = Path(cacheDirectory) / f"{key}.marshal"
+
+    if cacheFile.exists():
+        with open(cacheFile, "rb") as fp:
+            return marshal.load(fp)
+
+    code = compile(source, fileName, mode)
+
+    cacheFile.parent.mkdir(parents=True, exist_ok=True)
+    ## Write then rename so a concurrent process never loads a partial file
+    tempFile = cacheFile.with_suffix(f".{os.getpid()}.tmp")
+    with open(tempFile, "wb") as fp:
+        marshal.dump(code, fp)
+    tempFile.replace(cacheFile)
+
+    return code
+
+
 class ParsedExpressionArray:
-    def __init__(self, parsedExpression, fileName):
+    def __init__(self, parsedExpression, fileName, cacheDirectory=None):
         self.identifier = parsedExpression["identifier"]
         self.expression = parsedExpression["expression"]
         self.symbols = parsedExpression["symbols"]
         self.fileName = fileName
 
-        self.lambdaExpression = compile(self.expression, "<string>", mode="eval")
+        self.lambdaExpression = compileCached(
+            self.expression, "<string>", "eval", cacheDirectory
+        )
 
     def evaluate(self, params):
         return eval(self.lambdaExpression, {"log": log, "sqrt": sqrt, "params": params})
 
+    def evaluateBatch(self, params):
+        """params is indexed as params[symbol][point]"""
+        return eval(self.lambdaExpression, batchFunctions | {"params": params})
+
+    def evaluateReal(self, params):
+        try:
+            return eval(self.lambdaExpression, realFunctions | {"params": params})
+        except ValueError as error:
+            raise ComplexResultError(self.identifier) from error
+
+
+def defineFunction(code, namespace):
+    """Execute the code of a generated def and return the function it defines"""
+    namespace = dict(namespace)
+    exec(code, namespace)
+    return namespace[code.co_names[0]]
+
+
+def pythonArguments(function):
+    """Arithmetic on python numbers is much quicker than on numpy scalars, so
+    arrays of params are converted to lists before calling (python) function"""
+
+    def listFunction(params):
+        return function(params.tolist() if isinstance(params, np.ndarray) else params)
+
+    return listFunction
+
 
 class ParsedExpressionSystemArray:
-    def __init__(self, parsedExpressionSystem, allSymbols, fileName):
-        self.parsedExpressions = [
-            (
-                allSymbols.index(parsedExpression["identifier"]),
-                ParsedExpressionArray(parsedExpression, fileName),
-            )
+    def __init__(
+        self,
+        parsedExpressionSystem,
+        allSymbols,
+        fileName,
+        function=None,
+        cacheDirectory=None,
+        jitFunction=None,
+    ):
+        """function is the source of the whole system fused into a single def
+        (see PythoniseMathematica.pythoniseFunction), if not given each
+        expression is compiled and evaluated on its own.
+        If cacheDirectory is given compiled code is loaded from/saved to it.
+        jitFunction (e.g. from the numba backend) replaces the single point
+        evaluation, batches still go through numpy"""
+        self.indices = [
+            allSymbols.index(parsedExpression["identifier"])
             for parsedExpression in parsedExpressionSystem
         ]
 
+        if function:
+            code = compileCached(function, str(fileName), "exec", cacheDirectory)
+            self.function = defineFunction(code, {"log": log, "sqrt": sqrt})
+            self.functionBatch = defineFunction(code, batchFunctions)
+            self.functionReal = defineFunction(code, realFunctions)
+        else:
+            self.parsedExpressions = [
+                ParsedExpressionArray(parsedExpression, fileName, cacheDirectory)
+                for parsedExpression in parsedExpressionSystem
+            ]
+            self.function = self.evaluateEach
+            self.functionBatch = self.evaluateEachBatch
+            self.functionReal = self.evaluateEachReal
+
+        if jitFunction:
+            self.function = jitFunction
+            self.functionReal = self.evaluateJitReal
+        elif not any(
+            re.search(r"[<>]", parsedExpression["expression"])
+            for parsedExpression in parsedExpressionSystem
+        ):
+            ## Systems with comparisons (i.e. bounded) rely on numpy ordering
+            ## complex numbers so are left with numpy scalars
+            self.function = pythonArguments(self.function)
+
         self.allSymbols = allSymbols
         self.fileName = fileName
 
+    def evaluateEach(self, params):
+        return [expression.evaluate(params) for expression in self.parsedExpressions]
+
+    def evaluateEachBatch(self, params):
+        return [
+            expression.evaluateBatch(params) for expression in self.parsedExpressions
+        ]
+
+    def evaluateEachReal(self, params):
+        return [expression.evaluateReal(params) for expression in self.parsedExpressions]
+
+    def evaluateJitReal(self, params):
+        ## Jit code is already fast so there is no real version, just make sure
+        ## complex results are caught the same way
+        values = self.function(params)
+        if np.any(np.imag(values)):
+            raise ComplexResultError("Complex result in real evaluation")
+        return np.real(values)
+
     def evaluate(self, params):
         newParams = np.array(params, dtype="complex")
-        for expression in self.parsedExpressions:
-            newParams[expression[0]] = expression[1].evaluate(params)
+        newParams[self.indices] = self.function(params)
 
         return newParams
 
+    def evaluateInPlace(self, params):
+        """evaluate writing into params (a complex array) rather than a copy of it"""
+        params[self.indices] = self.function(params)
+
+        return params
+
     def evaluateUnordered(self, params):
-        return [expression[1].evaluate(params) for expression in self.parsedExpressions]
+        return self.function(params)
+
+    def evaluateReal(self, params):
+        """evaluate in float64 arithmetic, raises ComplexResultError so the caller
+        can fall back to evaluate. params must be real"""
+        ## Python floats so fractional powers of negatives give complex not nan
+        return self.evaluateInPlaceReal(np.array(params, dtype="float"))
+
+    def evaluateInPlaceReal(self, params):
+        """evaluateReal writing into params (a float array) rather than a copy of it"""
+        values = self.evaluateUnorderedReal(params.tolist())
+        try:
+            params[self.indices] = values
+        except TypeError as error:
+            ## A complex value doesn't fit in the float array
+            raise ComplexResultError("Complex result in real evaluation") from error
+
+        return params
+
+    def evaluateUnorderedReal(self, params):
+        """Real version of evaluateUnordered, params should be a list of python
+        floats. Raises ComplexResultError for a log or sqrt of a negative number"""
+        try:
+            return self.functionReal(params)
+        except ValueError as error:
+            raise ComplexResultError(self.fileName) from error
+
+    def evaluateBatch(self, paramsMatrix):
+        """Same as evaluate but for a (N, len(allSymbols)) array of N points"""
+        newParams = np.array(paramsMatrix, dtype="complex")
+        newParams[:, self.indices] = self.evaluateUnorderedBatch(newParams)
+
+        return newParams
+
+    def evaluateUnorderedBatch(self, paramsMatrix):
+        """Same as evaluateUnordered but returns a (N, len(expressions)) array"""
+        ## Transposed copy so params[idx] is a contiguous row of N values
+        params = np.ascontiguousarray(np.asarray(paramsMatrix, dtype="complex").T)
+        ## Broadcast so constant expressions still give one value per point
+        return np.transpose(
+            [
+                np.broadcast_to(value, params.shape[1:])
+                for value in self.functionBatch(params)
+            ]
+        )
+
+    def evaluateTensorBatch(self, paramsMatrix):
+        """evaluateUnorderedBatch for systems whose expressions are (nested tuples
+        of) matrices, returns a (N, len(expressions), ...) array"""
+        params = np.ascontiguousarray(np.asarray(paramsMatrix, dtype="complex").T)
+
+        def broadcast(value):
+            if isinstance(value, tuple):
+                return [broadcast(element) for element in value]
+            return np.broadcast_to(value, params.shape[1:])
+
+        return np.moveaxis(np.array(broadcast(tuple(self.functionBatch(params)))), -1, 0)
 
     def dictToArray(self, params):
         return [params[key] if key in params else 0 for key in self.allSymbols]
@@ -138,3 +352,156 @@ class ParsedExpressionUnitTests(TestCase):
             ParsedExpressionSystem(source, None).evaluate({"lam": 100, "mssq": 100}),
         )
 
+    def test_indexSymbols(self):
+        source = [
+            {
+                "expression": "((lam*v1**2 + 1e-05, sqrt(lam2)), (0, log(v1)))",
+                "identifier": "missing",
+                "symbols": ["lam", "lam2", "v1"],
+            }
+        ]
+
+        reference = "((params[1]*params[0]**2 + 1e-05, sqrt(params[2])), (0, log(params[0])))"
+
+        self.assertEqual(
+            reference, indexSymbols(source, ["v1", "lam", "lam2"])[0]["expression"]
+        )
+
+    def test_ParsedExpressionSystemArrayBatch(self):
+        source = [
+            {
+                "expression": "sqrt(params[0]) + log(params[1])",
+                "identifier": "c",
+                "symbols": ["a", "b"],
+            },
+            {
+                "expression": "min(0, params[0]) + params[1]**(3/2)",
+                "identifier": "d",
+                "symbols": ["a", "b"],
+            },
+            {
+                "expression": "2",
+                "identifier": "a",
+                "symbols": [],
+            },
+        ]
+        allSymbols = ["a", "b", "c", "d"]
+        paramsMatrix = [[100.0, 100.0, 0, 0], [-4.0, 9.0, 0, 0], [2.0, -1.0, 0, 0]]
+
+        system = ParsedExpressionSystemArray(source, allSymbols, None)
+
+        reference = [system.evaluate(params) for params in paramsMatrix]
+        np.testing.assert_allclose(reference, system.evaluateBatch(paramsMatrix))
+
+        reference = [system.evaluateUnordered(params) for params in paramsMatrix]
+        np.testing.assert_allclose(
+            reference, system.evaluateUnorderedBatch(paramsMatrix)
+        )
+
+    def test_ParsedExpressionSystemArrayTensorBatch(self):
+        source = [
+            {
+                "expression": "((params[0], 2), (2, sqrt(params[1])))",
+                "identifier": "m",
+                "symbols": ["a", "b"],
+            },
+        ]
+        function = (
+            "def system(params):\n"
+            "    p0 = params[0]\n"
+            "    p1 = params[1]\n"
+            "    return (\n"
+            "        ((p0, 2), (2, sqrt(p1))),\n"
+            "    )\n"
+        )
+        allSymbols = ["a", "b", "m"]
+        paramsMatrix = [[1.0, 4.0, 0], [-4.0, 9.0, 0], [2.0, -1.0, 0]]
+
+        system = ParsedExpressionSystemArray(source, allSymbols, None, function)
+
+        reference = [system.evaluateUnordered(params) for params in paramsMatrix]
+        np.testing.assert_allclose(reference, system.evaluateTensorBatch(paramsMatrix))
+
+    def test_ParsedExpressionSystemArrayFunction(self):
+        source = [
+            {
+                "expression": "sqrt(params[0]) + log(params[1])",
+                "identifier": "c",
+                "symbols": ["a", "b"],
+            },
+            {
+                "expression": "min(0, params[0]) + params[1]**(3/2)",
+                "identifier": "a",
+                "symbols": ["a", "b"],
+            },
+        ]
+        function = (
+            "def system(params):\n"
+            "    p0 = params[0]\n"
+            "    p1 = params[1]\n"
+            "    return (\n"
+            "        sqrt(p0) + log(p1),\n"
+            "        min(0, p0) + p1**(3/2),\n"
+            "    )\n"
+        )
+        allSymbols = ["a", "b", "c"]
+        paramsMatrix = [[100.0, 100.0, 0], [-4.0, 9.0, 0], [2.0, -1.0, 0]]
+
+        reference = ParsedExpressionSystemArray(source, allSymbols, None)
+        fused = ParsedExpressionSystemArray(source, allSymbols, None, function)
+
+        for params in paramsMatrix:
+            self.assertEqual(
+                list(reference.evaluate(params)), list(fused.evaluate(params))
+            )
+        np.testing.assert_allclose(
+            reference.evaluateBatch(paramsMatrix), fused.evaluateBatch(paramsMatrix)
+        )
+
+    def test_compileCached(self):
+        from tempfile import TemporaryDirectory
+
+        source = "sqrt(lam) + log(mssq)"
+
+        with TemporaryDirectory() as cacheDirectory:
+            compiled = compileCached(source, "<string>", "eval", cacheDirectory)
+            self.assertEqual(1, len(list(Path(cacheDirectory).iterdir())))
+
+            cached = compileCached(source, "<string>", "eval", cacheDirectory)
+            self.assertEqual(compiled, cached)
+            self.assertEqual(1, len(list(Path(cacheDirectory).iterdir())))
+
+    def test_ParsedExpressionSystemArrayReal(self):
+        source = [
+            {
+                "expression": "sqrt(params[0]) + log(params[1])",
+                "identifier": "c",
+                "symbols": ["a", "b"],
+            },
+        ]
+        allSymbols = ["a", "b", "c"]
+
+        system = ParsedExpressionSystemArray(source, allSymbols, None)
+
+        self.assertEqual(
+            list(system.evaluate([4.0, 1.0, 0])), list(system.evaluateReal([4.0, 1.0, 0]))
+        )
+        self.assertEqual(
+            system.evaluateUnordered([4.0, 1.0, 0]),
+            system.evaluateUnorderedReal([4.0, 1.0, 0]),
+        )
+        with self.assertRaises(ComplexResultError):
+            system.evaluateReal([-4.0, 1.0, 0])
+        with self.assertRaises(ComplexResultError):
+            system.evaluateUnorderedReal([4.0, -1.0, 0])
+
+    def test_ParsedExpressionSystemArrayInPlace(self):
+        source = [
+            {"expression": "params[0] * params[1]", "identifier": "c", "symbols": ["a", "b"]},
+        ]
+        system = ParsedExpressionSystemArray(source, ["a", "b", "c"], None)
+
+        params = np.array([2, 3 + 1j, 0], dtype=complex)
+        reference = system.evaluate(params)
+        self.assertIs(params, system.evaluateInPlace(params))
+        np.testing.assert_array_equal(reference, params)
@@ -47,6 +47,8 @@ def interpretData(result, bmNumber, bmInput, fieldNames):
 
     processedResult["steps"] = len(PTTemps)
     processedResult["bIsPerturbative"] = bool(np.all(result["bIsPerturbative"]))
+    if "bIsStable" in result:
+        processedResult["bIsStable"] = bool(np.all(result["bIsStable"]))
     imag2RealRatio = abs(
         np.array(result["vevDepthImag"]) / np.array(result["vevDepthReal"])
     )
@@ -0,0 +1,153 @@
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from time import perf_counter
+
+
+class Profiler:
+    """Counts calls and accumulates wall time of named blocks of code,
+    split by temperature. A disabled profiler does nothing, and methods
+    are only wrapped (see instrument) when enabled so there is no overhead"""
+
+    def __init__(self, bEnabled=False):
+        self.bEnabled = bEnabled
+        self.reset()
+
+    def reset(self):
+        ## records is indexed as records[temperature][name] = [calls, time, selfTime]
+        self.records = {}
+        self.temperature = None
+        ## Time spent in nested timers, so time excluding them (selfTime) can be found
+        self.childTimes = []
+
+    def setTemperature(self, T):
+        self.temperature = T
+
+    def timer(self, name):
+        if not self.bEnabled:
+            return nullcontext()
+
+        return self.enabledTimer(name)
+
+    @contextmanager
+    def enabledTimer(self, name):
+        self.childTimes.append(0.0)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            childTime = self.childTimes.pop()
+            if self.childTimes:
+                self.childTimes[-1] += elapsed
+
+            record = self.records.setdefault(self.temperature, {}).setdefault(
+                name, [0, 0.0, 0.0]
+            )
+            record[0] += 1
+            record[1] += elapsed
+            record[2] += elapsed - childTime
+
+    def instrument(self, instance, name, methodNames):
+        """Replace the methods of instance with timed versions named name.method"""
+        if not self.bEnabled:
+            return instance
+
+        for methodName in methodNames:
+            method = getattr(instance, methodName)
+
+            ## object.__setattr__ as some instances are frozen dataclasses
+            object.__setattr__(
+                instance, methodName, self.timed(f"{name}.{methodName}", method)
+            )
+
+        return instance
+
+    def timed(self, name, function):
+        @wraps(function)
+        def timedFunction(*args, **kwargs):
+            with self.enabledTimer(name):
+                return function(*args, **kwargs)
+
+        return timedFunction
+
+    def summary(self):
+        """Records as a json friendly dict, in total and per temperature
+        (work done before the first temperature is under setup)"""
+
+        def recordsDict(records):
+            return {
+                name: {"calls": calls, "time": time, "selfTime": selfTime}
+                for name, (calls, time, selfTime) in sorted(
+                    records.items(), key=lambda item: -item[1][1]
+                )
+            }
+
+        total = {}
+        for records in self.records.values():
+            for name, record in records.items():
+                totalRecord = total.setdefault(name, [0, 0.0, 0.0])
+                for idx, value in enumerate(record):
+                    totalRecord[idx] += value
+
+        return {
+            "total": recordsDict(total),
+            "setup": recordsDict(self.records.get(None, {})),
+            "perTemperature": {
+                str(T): recordsDict(records)
+                for T, records in self.records.items()
+                if T is not None
+            },
+        }
+
+
+from unittest import TestCase
+
+
+class ProfilerUnitTests(TestCase):
+    def test_disabled(self):
+        profiler = Profiler()
+
+        class Instance:
+            def method(self):
+                with profiler.timer("block"):
+                    return 1
+
+        instance = profiler.instrument(Instance(), "instance", ["method"])
+
+        self.assertEqual(1, instance.method())
+        self.assertEqual({}, profiler.records)
+
+    def test_enabled(self):
+        reference = {
+            "total": {"instance.method": 2, "block": 2},
+            "setup": {"instance.method": 1, "block": 1},
+            "perTemperature": {"100": {"instance.method": 1, "block": 1}},
+        }
+
+        profiler = Profiler(bEnabled=True)
+
+        class Instance:
+            def method(self):
+                with profiler.timer("block"):
+                    return 1
+
+        instance = profiler.instrument(Instance(), "instance", ["method"])
+        instance.method()
+        profiler.setTemperature(100)
+        instance.method()
+
+        summary = profiler.summary()
+        self.assertEqual(
+            reference,
+            {
+                "total": {name: v["calls"] for name, v in summary["total"].items()},
+                "setup": {name: v["calls"] for name, v in summary["setup"].items()},
+                "perTemperature": {
+                    T: {name: v["calls"] for name, v in records.items()}
+                    for T, records in summary["perTemperature"].items()
+                },
+            },
+        )
+        ## The block is nested in the method so the method's self time excludes it
+        method = summary["total"]["instance.method"]
+        self.assertLessEqual(method["selfTime"], method["time"])
@@ -1,12 +1,17 @@
 import json
 from sympy.parsing.mathematica import parse_mathematica
+from sympy import Add, Expr, Matrix, Symbol, Tuple, cse, horner, numbered_symbols, preorder_traversal
 from numpy import euler_gamma, pi
-from pathlib import Path
+from hashlib import sha256
 from importlib.resources import files
 import unicodedata
 import re
+from itertools import chain
+from io import StringIO
+from pathos.multiprocessing import Pool
 
-from Veff_generation import generate_veff_module, compile_veff_submodule
+from Bloop.ModelFile import ModelFile, writeModelFile
+from Veff_generation import generate_veff_module, generate_cython_systems, compile_veff_submodule
 
 def getLines(relativePathToResource):
     with open(files(__package__) / relativePathToResource, "r", encoding="utf-8") as fp:
@@ -54,13 +59,121 @@ def replaceSymbolsWithIndices(expression, symbols):
     return expression
 
 
-def pythoniseExpressionArray(line, allSymbols):
+def splitIdentifier(line):
     identifier, line = (
         map(str.strip, line.split("->")) if ("->" in line) else ("missing", line)
     )
 
-    identifier = removeSuffices(replaceGreekSymbols(identifier))
-    expression = parse_mathematica(replaceSymbolsConst(replaceGreekSymbols(line)))
+    return removeSuffices(replaceGreekSymbols(identifier)), line
+
+
+## parse_mathematica reads a^-2 + b as a^(-2 + b) (Mathematica's 1/a^2 + b), so
+## signed exponents (a number, symbol, function call or bracket) are bracketed first
+signedExponent = re.compile(r"\^\s*([+-])\s*(\([^()]*\)|[\w.]+(?:\[[^\[\]]*\])?)")
+
+
+def parseMathematicaString(string):
+    string = signedExponent.sub(r"^(\1\2)", string)
+    return parse_mathematica(replaceSymbolsConst(replaceGreekSymbols(string)))
+
+
+## Lines are parsed once and shared by every system built from them (veff, veffArray,
+## gradients etc), parseLines fills this in parallel. Cleared after each conversion
+parsedLines = {}
+
+
+def parseLine(line):
+    if line not in parsedLines:
+        identifier, string = splitIdentifier(line)
+        parsedLines[line] = (identifier, parseMathematicaString(string))
+
+    return parsedLines[line]
+
+
+## Length (in characters) of the chunks long sums are split into
+summandChunkLength = 50_000
+
+
+def streamSummands(fp, chunkLength, blockSize=1 << 16):
+    """Yield the lines of fp, splitting lines into chunks of roughly chunkLength
+    characters at + and - that are outside of brackets and not unary, so the chunks
+    of a line sum to it. fp is read in blocks so the whole file is never in memory"""
+    pieces, depth, previous = [], 0, ""
+    while block := fp.read(blockSize):
+        start = 0
+        for idx, character in enumerate(block):
+            if character in "([{":
+                depth += 1
+            elif character in ")]}":
+                depth -= 1
+            elif character == "\n" and depth == 0:
+                chunk = "".join(pieces) + block[start:idx]
+                if chunk and not chunk.isspace():
+                    yield chunk
+                pieces, start, previous = [], idx + 1, ""
+                continue
+            elif character in "+-" and depth == 0:
+                ## The sign of an exponent (a^-2) is unary too, the exponent ends at the
+                ## next + or - (see signedExponent) so splitting carries on after it
+                if (
+                    previous not in "*/+-^,([{"
+                    and sum(map(len, pieces)) + idx - start >= chunkLength
+                ):
+                    yield "".join(pieces) + block[start:idx]
+                    pieces, start = [], idx
+
+            if not character.isspace():
+                previous = character
+
+        pieces.append(block[start:])
+
+    chunk = "".join(pieces)
+    if chunk and not chunk.isspace():
+        yield chunk
+
+
+def splitSummands(string, chunkLength):
+    return list(streamSummands(StringIO(string), chunkLength))
+
+
+def getVeffLines(veffFile, bStream):
+    """Lines of a potential file, if streaming they're split into chunks (summed when
+    Veff is evaluated) so no sympy expression of a whole (huge) sum is ever built"""
+    if not bStream:
+        return getLines(veffFile)
+
+    with open(files(__package__) / veffFile, "r", encoding="utf-8") as fp:
+        return list(streamSummands(fp, summandChunkLength))
+
+
+def parseLines(lines, bPool=False, cores=1, chunkLength=summandChunkLength):
+    """Parse lines into parsedLines, long lines are split into sums of chunks so
+    the work (dominated by the NNLO potential, one very long line) spreads over the pool"""
+    newLines = [line for line in dict.fromkeys(lines) if line not in parsedLines]
+    identifiers, chunks = [], []
+    for line in newLines:
+        identifier, string = splitIdentifier(line)
+        identifiers.append(identifier)
+        chunks.append(splitSummands(string, chunkLength))
+
+    flatChunks = list(chain(*chunks))
+    if bPool and cores > 1 and len(flatChunks) > 1:
+        with Pool(cores) as pool:
+            parsedChunks = iter(pool.map(parseMathematicaString, flatChunks))
+    else:
+        parsedChunks = map(parseMathematicaString, flatChunks)
+
+    ## Single chunks aren't put through Add as they may be relations (i.e. bounded)
+    for line, identifier, lineChunks in zip(newLines, identifiers, chunks):
+        expressions = [next(parsedChunks) for _ in lineChunks]
+        parsedLines[line] = (
+            identifier,
+            expressions[0] if len(expressions) == 1 else Add(*expressions),
+        )
+
+
+def pythoniseExpressionArray(line, allSymbols):
+    identifier, expression = parseLine(line)
     symbols = [str(symbol) for symbol in expression.free_symbols]
 
     return {
@@ -70,13 +183,10 @@ def pythoniseExpressionArray(line, allSymbols):
     }
 
 
-def pythoniseExpression(line):
-    identifier, line = (
-        map(str.strip, line.split("->")) if ("->" in line) else ("missing", line)
-    )
-
-    identifier = removeSuffices(replaceGreekSymbols(identifier))
-    expression = parse_mathematica(replaceSymbolsConst(replaceGreekSymbols(line)))
+def pythoniseExpression(line, hoist=None):
+    identifier, expression = parseLine(line)
+    if hoist:
+        expression = hoist(expression)
     symbols = [str(symbol) for symbol in expression.free_symbols]
 
     return {
@@ -90,8 +200,287 @@ def pythoniseExpressionSystemArray(lines, allSymbols):
     return [pythoniseExpressionArray(line, allSymbols) for line in lines]
 
 
-def pythoniseExpressionSystem(lines):
-    return [pythoniseExpression(line) for line in lines]
+def pythoniseSympyArray(identifiers, expressions, allSymbols, bCSE=False):
+    """Pythonise already parsed (sympy) expressions into an array system,
+    optionally with common subexpressions (across all of its expressions)
+    pulled out into temporaries named cse0, cse1, ...
+    Symbols are swapped for params[idx] before the cse so the temporaries
+    never go through the string replacement of replaceSymbolsWithIndices"""
+    indexSymbols = {
+        Symbol(symbol): Symbol(f"params[{idx}]") for idx, symbol in enumerate(allSymbols)
+    }
+    reducedExpressions = [expression.xreplace(indexSymbols) for expression in expressions]
+
+    replacements = []
+    if bCSE:
+        replacements, reducedExpressions = cse(
+            reducedExpressions, symbols=numbered_symbols("cse")
+        )
+
+    temporaries = [
+        {"identifier": str(symbol), "expression": str(expression)}
+        for symbol, expression in replacements
+    ]
+    expressionSystem = [
+        {
+            "identifier": identifier,
+            "expression": str(reducedExpression),
+            "symbols": sorted(str(symbol) for symbol in expression.free_symbols),
+        }
+        for identifier, expression, reducedExpression in zip(
+            identifiers, expressions, reducedExpressions
+        )
+    ]
+
+    return expressionSystem, temporaries
+
+
+def pythoniseExpressionSystemArrayCSE(lines, allSymbols):
+    identifiers, expressions = zip(*[parseLine(line) for line in lines])
+    return pythoniseSympyArray(identifiers, expressions, allSymbols, bCSE=True)
+
+
+def pythoniseExpressionSystem(lines, hoist=None):
+    return [pythoniseExpression(line, hoist) for line in lines]
+
+
+def pythoniseArraySystem(lines, allSymbols, fileName, bCSE, hoist=None):
+    if not bCSE and not hoist:
+        return {
+            "expressions": pythoniseExpressionSystemArray(lines, allSymbols),
+            "fileName": fileName,
+        }
+
+    identifiers, expressions = zip(*[parseLine(line) for line in lines])
+    if hoist:
+        expressions = [hoist(expression) for expression in expressions]
+
+    expressionSystem, temporaries = pythoniseSympyArray(
+        identifiers, expressions, allSymbols, bCSE
+    )
+    if not bCSE:
+        return {"expressions": expressionSystem, "fileName": fileName}
+
+    return {
+        "expressions": expressionSystem,
+        "temporaries": temporaries,
+        "fileName": fileName,
+    }
+
+
+def fieldDependentVectors(vectorLines, fields):
+    """Outputs of the vector systems (short hands feed into the vector masses)
+    in terms of the input params, and which of them depend on the fields"""
+    substitutions = {}
+    for identifier, expression in map(parseLine, vectorLines):
+        substitutions[Symbol(identifier)] = expression.xreplace(substitutions)
+
+    return substitutions, [
+        symbol
+        for symbol, expression in substitutions.items()
+        if expression.free_symbols & set(fields)
+    ]
+
+
+def hoistFieldIndependent(expression, dependentSymbols, coefficients, allSymbols):
+    """Replace the field independent parts of expression with coefficients
+    coeff0, coeff1, ... so they can be computed once per temperature.
+    Independent terms of a sum (factors of a product) are grouped into one
+    coefficient. coefficients ({expression: symbol}) is shared between calls
+    and new coefficients are appended to allSymbols"""
+    bDependentCache = {}
+
+    def bDependent(node):
+        if node not in bDependentCache:
+            bDependentCache[node] = not node.free_symbols.isdisjoint(dependentSymbols)
+        return bDependentCache[node]
+
+    def coefficient(node):
+        ## Nothing to save for a lone symbol or number, matrix rows can't be params
+        if node.is_Atom or not isinstance(node, Expr):
+            return node
+
+        if node not in coefficients:
+            coefficients[node] = Symbol(f"coeff{len(coefficients)}")
+            allSymbols.append(str(coefficients[node]))
+        return coefficients[node]
+
+    def hoist(node):
+        if not bDependent(node):
+            return coefficient(node)
+
+        if node.is_Atom:
+            return node
+
+        if node.is_Add or node.is_Mul:
+            independent = [arg for arg in node.args if not bDependent(arg)]
+            dependent = [hoist(arg) for arg in node.args if bDependent(arg)]
+            if independent:
+                dependent.append(coefficient(node.func(*independent)))
+            return node.func(*dependent)
+
+        return node.func(*map(hoist, node.args))
+
+    return hoist(expression)
+
+
+def operationCount(expression):
+    ## Rough number of additions and multiplications, integer powers count as
+    ## repeated multiplication and anything else as a (more expensive) call
+    count = 0
+    for node in preorder_traversal(expression):
+        if node.is_Add or node.is_Mul:
+            count += len(node.args) - 1
+        elif node.is_Pow:
+            count += abs(int(node.exp)) - 1 if node.exp.is_Integer else 10
+        elif node.is_Function:
+            count += 10
+    return count
+
+
+def hornerForm(expression, fields):
+    """Write polynomials in the fields in (multivariate) Horner form, so products of
+    fields are shared between terms and the coefficient of each monomial is collected
+    (and hoisted as one). Matrices (tuples) are done element wise and expressions are
+    kept as is when the Horner form isn't cheaper"""
+    if not isinstance(expression, Expr):
+        return expression.func(*[hornerForm(arg, fields) for arg in expression.args])
+
+    presentFields = [field for field in fields if field in expression.free_symbols]
+    if not presentFields or not expression.is_polynomial(*presentFields):
+        return expression
+
+    hornerExpression = horner(expression, *presentFields)
+    if operationCount(hornerExpression) < operationCount(expression):
+        return hornerExpression
+    return expression
+
+
+def hornerLines(lines, fields):
+    ## Swap the cached parse of the lines for their Horner form, so every system
+    ## built from them (and every backend) uses it
+    for line in lines:
+        identifier, expression = parseLine(line)
+        parsedLines[line] = (identifier, hornerForm(expression, fields))
+
+
+def pythoniseGradients(
+    veffLines,
+    vectorLines,
+    scalarMassMatrixLines,
+    fieldSymbols,
+    scalarMassNames,
+    rotationSymbols,
+    allSymbols,
+    bCSE,
+    hoist=None,
+):
+    """Symbolic derivatives needed for the gradient of Veff w.r.t. the fields:
+    veffPartials: partial derivatives of Veff w.r.t. every field dependent symbol
+    (fields, vector masses, scalar eigenvalues and rotation matrix entries),
+    vectorMassesJacobian: d(vector mass)/d(field), flattened as [mass][field],
+    scalarMassMatricesJacobian: d(scalar mass matrices)/d(field), one per field.
+    The eigenvalue/rotation chain rule needs the eigen system at the point so
+    is done numerically in EffectivePotential.evaluatePotentialGradient.
+    hoist (see hoistFieldIndependent) is applied to every derivative"""
+    fields = [Symbol(field) for field in fieldSymbols]
+    hoist = hoist or (lambda expression: expression)
+
+    substitutions, vectorSymbols = fieldDependentVectors(vectorLines, fields)
+    vectorMassesJacobian = pythoniseSympyArray(
+        [str(symbol) for symbol in vectorSymbols for field in fields],
+        [
+            hoist(substitutions[symbol].diff(field))
+            for symbol in vectorSymbols
+            for field in fields
+        ],
+        allSymbols,
+    )[0]
+
+    massMatrices = [
+        Matrix(parseLine(line)[1]).xreplace(substitutions)
+        for line in scalarMassMatrixLines
+    ]
+    scalarMassMatricesJacobian = []
+    for field in fields:
+        derivatives = [matrix.diff(field).applyfunc(hoist) for matrix in massMatrices]
+        scalarMassMatricesJacobian.append(
+            {
+                "identifier": str(field),
+                "expression": str(
+                    Tuple(
+                        *[
+                            Tuple(*[Tuple(*row) for row in matrix.tolist()])
+                            for matrix in derivatives
+                        ]
+                    )
+                ),
+                "symbols": sorted(
+                    {str(symbol) for matrix in derivatives for symbol in matrix.free_symbols}
+                ),
+            }
+        )
+
+    veffExpressions = [parseLine(line)[1] for line in veffLines]
+    partialSymbols = (
+        fields
+        + vectorSymbols
+        + [Symbol(name) for name in chain(scalarMassNames, rotationSymbols)]
+    )
+    partials = {
+        symbol: hoist(Add(*[expression.diff(symbol) for expression in veffExpressions]))
+        for symbol in partialSymbols
+    }
+    partials = {symbol: partial for symbol, partial in partials.items() if partial != 0}
+    expressionSystem, temporaries = pythoniseSympyArray(
+        [str(symbol) for symbol in partials], list(partials.values()), allSymbols, bCSE
+    )
+
+    return {
+        "veffPartials": {
+            "expressions": expressionSystem,
+            "temporaries": temporaries,
+            "fileName": "Combined Veff files",
+        },
+        "vectorMassesJacobian": {
+            "expressions": vectorMassesJacobian,
+            "fileName": "Vector masses jacobian",
+        },
+        "scalarMassMatricesJacobian": {
+            "expressions": scalarMassMatricesJacobian,
+            "fileName": "Scalar mass matrices jacobian",
+        },
+    }
+
+
+def pythoniseFunction(name, expressionSystem, temporaries=()):
+    """Fuse an array expression system into the source of a single function,
+    params is read once into locals, temporaries (from the optional cse)
+    are assigned in order and all outputs are returned as a tuple"""
+    paramsPattern = re.compile(r"params\[(\d+)\]")
+    indices = sorted(
+        {
+            int(index)
+            for expression in chain(temporaries, expressionSystem)
+            for index in paramsPattern.findall(expression["expression"])
+        }
+    )
+
+    lines = [f"def {name}(params):"]
+    lines += [f"    p{index} = params[{index}]" for index in indices]
+    lines += [
+        f"    {temporary['identifier']} = "
+        + paramsPattern.sub(r"p\1", temporary["expression"])
+        for temporary in temporaries
+    ]
+    lines.append("    return (")
+    lines += [
+        "        " + paramsPattern.sub(r"p\1", expression["expression"]) + ","
+        for expression in expressionSystem
+    ]
+    lines.append("    )")
+
+    return "\n".join(lines) + "\n"
 
 
 def pythoniseMatrix(lines):
@@ -101,75 +490,359 @@ def pythoniseMatrix(lines):
     ]
 
 
+arraySystemNames = (
+    "bounded",
+    "betaFunctions4D",
+    "hardToSoft",
+    "softScaleRGE",
+    "softToUltraSoft",
+    "vectorMassesSquared",
+    "vectorShortHands",
+    "veffArray",
+    "veffPartials",
+    "vectorMassesJacobian",
+    "fieldIndependent",
+)
+
+
+## Part of every section's hash, bump it whenever the converter's output changes
+## (format of a section, how expressions are written, ...) so old sections are rebuilt
+converterVersion = "4"
+
+
+def hashInputs(fileNames, argValues, version=converterVersion):
+    """Hash of the converter version, the contents of the files and the argument
+    values a section is built from"""
+    digest = sha256(json.dumps([version, fileNames, argValues]).encode())
+    for fileName in fileNames:
+        digest.update((files(__package__) / fileName).read_bytes())
+
+    return digest.hexdigest()
+
+
+def loadPythonisedExpressions(pythonisedExpressionsFile):
+    try:
+        return ModelFile(pythonisedExpressionsFile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+gradientSectionNames = (
+    "veffPartials",
+    "vectorMassesJacobian",
+    "scalarMassMatricesJacobian",
+)
+
+
+## Sections that share hoisted coefficients, so have to be rebuilt together.
+## scalarMassMatrices is left unhoisted for the benchmark generator, which
+## evaluates it with the physical params, the potential uses the hoisted copy
+hoistedSectionNames = (
+    "vectorMassesSquared",
+    "hoistedScalarMassMatrices",
+    "veffArray",
+    *gradientSectionNames,
+    "fieldIndependent",
+)
+
+## Sections each conversion flag changes, only those sections hash the flag so
+## toggling it doesn't rebuild the others.
+## bCSE is passed to every array system and the gradients
+cseSectionNames = (*arraySystemNames, "scalarMassMatricesJacobian")
+## The loop corrections are streamed, the tree level never is
+streamedSectionNames = (
+    "veffNLO",
+    "veffNNLO",
+    "veffArray",
+    *gradientSectionNames,
+    "fieldIndependent",
+)
+## The tree level potential and masses are put in Horner form
+hornerSectionNames = (
+    "veffLO",
+    "veffArray",
+    "vectorMassesSquared",
+    "scalarMassMatrices",
+    "hoistedScalarMassMatrices",
+    *gradientSectionNames,
+    "fieldIndependent",
+)
+
+
+def sectionArgs(name, args, sectionNames):
+    """Argument values the section called name is built from, sectionNames are all
+    the sections of this conversion"""
+    sectionArgValues = {}
+    if name in cseSectionNames:
+        sectionArgValues["bCSE"] = args.bCSE
+    if name in hoistedSectionNames:
+        sectionArgValues["bHoist"] = args.bHoist
+        ## Coefficient numbering depends on which hoisted sections exist
+        sectionArgValues["hoistedSections"] = (
+            [hoisted for hoisted in hoistedSectionNames if hoisted in sectionNames]
+            if args.bHoist
+            else []
+        )
+    if name in streamedSectionNames:
+        sectionArgValues["bStreamVeff"] = args.bStreamVeff
+    if name in hornerSectionNames:
+        sectionArgValues["bHorner"] = args.bHorner
+
+    return sectionArgValues
+
+
+def staleSectionNames(inputHashes, previous, bHoist):
+    """Sections whose input hash differs from the previous conversion's, along with
+    the sections that have to be rebuilt with them"""
+    staleSections = {
+        name
+        for name, inputHash in inputHashes.items()
+        if previous.get("inputHashes", {}).get(name) != inputHash or name not in previous
+    }
+    if bHoist and staleSections & set(hoistedSectionNames):
+        staleSections |= set(hoistedSectionNames) & set(inputHashes)
+    if staleSections & set(gradientSectionNames):
+        staleSections |= set(gradientSectionNames)
+
+    return staleSections
+
+
 def pythoniseMathematica(args):
-    veffLines = getLines(args.loFile)
-    veffLines += getLines(args.nloFile)
+    veffFiles = [args.loFile, args.nloFile]
     if args.loopOrder >= 2:
-        veffLines += getLines(args.nnloFile)
+        veffFiles.append(args.nnloFile)
+
+    ## The tree level is small so isn't streamed, keeping it as veff's first expression
+    def veffFileLines(veffFile):
+        return getVeffLines(veffFile, args.bStreamVeff and veffFile != args.loFile)
+
+    veffLines = list(chain(*[veffFileLines(veffFile) for veffFile in veffFiles]))
     
     scalarRotationMatrix = getLinesJSON(args.scalarRotationMatrixFile)
     allSymbols = getLinesJSON(args.allSymbolsFile) + ["missing"]
     allSymbols = sorted(
         [replaceGreekSymbols(symbol) for symbol in allSymbols], reverse=True
     )
+    lagranianVariables = getLinesJSON(args.lagranianVariablesFile)
+    scalarMassNames = getLinesJSON(args.scalarMassNamesFile)
+    vectorFiles = [args.vectorShortHandsFile, args.vectorMassesSquaredFile]
+    vectorLines = list(chain(*[getLines(vectorFile) for vectorFile in vectorFiles]))
 
-    ## Move get lines to the functions? -- Would need to rework veffLines in this case
-    ## Not ideal to have nested dicts but is future proof for when we move to arrays
-    expressionDict = {
-        "bounded": {
-            "expressions": pythoniseExpressionSystemArray(
-                getLines(args.boundedConditions), allSymbols
-            ),
-            "fileName": "bounded",
-        },
-        "betaFunctions4D": {
-            "expressions": pythoniseExpressionSystemArray(
-                getLines(args.betaFunctions4DFile), allSymbols
-            ),
-            "fileName": args.betaFunctions4DFile,
-        },
-        "hardToSoft": {
-            "expressions": pythoniseExpressionSystemArray(
-                getLines(args.hardToSoftFile), allSymbols
-            ),
-            "fileName": args.hardToSoftFile,
-        },
-        "softScaleRGE": {
-            "expressions": pythoniseExpressionSystemArray(
-                getLines(args.softScaleRGEFile), allSymbols
-            ),
-            "fileName": args.softScaleRGEFile,
-        },
-        "softToUltraSoft": {
-            "expressions": pythoniseExpressionSystemArray(
-                getLines(args.softToUltraSoftFile), allSymbols
+    ## Derivatives are only needed by the gradient based local minimisers/Newton polish
+    bGradients = args.localMethod.startswith("LD_") or args.bNewtonPolish
+
+    ## Each loop order of the potential is its own section. The benchmark generator
+    ## only reads the tree level, the other orders are only kept with cython (which
+    ## has no veffArray) to check the compiled Veff against
+    veffSectionNames = dict(zip(veffFiles, ("veffLO", "veffNLO", "veffNNLO")))
+
+    ## Mathematica files each expression section is pythonised from
+    sectionFiles = {
+        "bounded": [args.boundedConditions],
+        "betaFunctions4D": [args.betaFunctions4DFile],
+        "hardToSoft": [args.hardToSoftFile],
+        "softScaleRGE": [args.softScaleRGEFile],
+        "softToUltraSoft": [args.softToUltraSoftFile],
+        "vectorMassesSquared": [args.vectorMassesSquaredFile],
+        "vectorShortHands": [args.vectorShortHandsFile],
+        "veffLO": [args.loFile],
+        "scalarMassMatrices": [args.scalarMassMatrixFile],
+    }
+    if args.bCython:
+        sectionFiles |= {name: [veffFile] for veffFile, name in veffSectionNames.items()}
+    else:
+        sectionFiles["veffArray"] = veffFiles
+    if bGradients:
+        for name in gradientSectionNames:
+            sectionFiles[name] = veffFiles + vectorFiles + [args.scalarMassMatrixFile]
+    if args.bHoist:
+        sectionFiles["hoistedScalarMassMatrices"] = [args.scalarMassMatrixFile]
+        hoistedFiles = list(
+            dict.fromkeys(
+                chain(
+                    vectorFiles,
+                    *[sectionFiles.get(name, []) for name in hoistedSectionNames],
+                )
+            )
+        )
+        for name in hoistedSectionNames:
+            if name in sectionFiles or name == "fieldIndependent":
+                sectionFiles[name] = hoistedFiles
+
+    ## Sections whose inputs (files, the variable files every section depends on and
+    ## args) are unchanged since the last conversion are copied over from its output.
+    ## loopOrder and bCython enter through which files/sections are used
+    variableFiles = [
+        args.allSymbolsFile,
+        args.lagranianVariablesFile,
+        args.scalarMassNamesFile,
+        args.scalarRotationMatrixFile,
+    ]
+    inputHashes = {
+        name: hashInputs(fileNames + variableFiles, sectionArgs(name, args, sectionFiles))
+        for name, fileNames in sectionFiles.items()
+    }
+    previous = loadPythonisedExpressions(args.pythonisedExpressionsFile)
+    staleSections = staleSectionNames(inputHashes, previous, args.bHoist)
+
+    if args.verbose:
+        print(f"Pythonising {sorted(staleSections)}, copying the other sections")
+
+    parseLines(
+        chain(
+            *[
+                veffFileLines(fileName)
+                if fileName in veffFiles
+                else getLines(fileName)
+                for fileName in dict.fromkeys(
+                    chain(*[sectionFiles[name] for name in staleSections])
+                )
+            ]
+        ),
+        args.bPool,
+        args.cores,
+    )
+
+    ## The tree level potential and masses are polynomials in the fields
+    if args.bHorner:
+        hornerLines(
+            chain(
+                veffFileLines(args.loFile),
+                getLines(args.vectorMassesSquaredFile),
+                getLines(args.scalarMassMatrixFile),
             ),
-            "fileName": args.softToUltraSoftFile,
+            [Symbol(field) for field in lagranianVariables["fieldSymbols"]],
+        )
+
+    ## Field independent parts of the systems evaluated at every field point are
+    ## pulled out into coefficients computed once per temperature. Their indices come
+    ## after allSymbols, which is left as is so only the potential sees them
+    hoistedSymbols, hoist = allSymbols, None
+    if args.bHoist:
+        fields = [Symbol(field) for field in lagranianVariables["fieldSymbols"]]
+        dependentSymbols = set(
+            fields
+            + fieldDependentVectors(vectorLines, fields)[1]
+            + [Symbol(name) for name in chain(scalarMassNames, scalarRotationMatrix)]
+        )
+        hoistedSymbols, coefficients = list(allSymbols), {}
+
+        def hoist(expression):
+            return hoistFieldIndependent(
+                expression, dependentSymbols, coefficients, hoistedSymbols
+            )
+
+    ## Builders are called in order so hoisted coefficients are numbered consistently
+    ## Not ideal to have nested dicts but is future proof for when we move to arrays
+    builders = {
+        "bounded": lambda: pythoniseArraySystem(
+            getLines(args.boundedConditions),
+            allSymbols,
+            "bounded",
+            args.bCSE,
+        ),
+        "betaFunctions4D": lambda: pythoniseArraySystem(
+            getLines(args.betaFunctions4DFile),
+            allSymbols,
+            args.betaFunctions4DFile,
+            args.bCSE,
+        ),
+        "hardToSoft": lambda: pythoniseArraySystem(
+            getLines(args.hardToSoftFile),
+            allSymbols,
+            args.hardToSoftFile,
+            args.bCSE,
+        ),
+        "softScaleRGE": lambda: pythoniseArraySystem(
+            getLines(args.softScaleRGEFile),
+            allSymbols,
+            args.softScaleRGEFile,
+            args.bCSE,
+        ),
+        "softToUltraSoft": lambda: pythoniseArraySystem(
+            getLines(args.softToUltraSoftFile),
+            allSymbols,
+            args.softToUltraSoftFile,
+            args.bCSE,
+        ),
+        "vectorMassesSquared": lambda: pythoniseArraySystem(
+            getLines(args.vectorMassesSquaredFile),
+            hoistedSymbols,
+            args.vectorMassesSquaredFile,
+            args.bCSE,
+            hoist,
+        ),
+        "vectorShortHands": lambda: pythoniseArraySystem(
+            getLines(args.vectorShortHandsFile),
+            allSymbols,
+            args.vectorShortHandsFile,
+            args.bCSE,
+        ),
+        **{
+            name: lambda veffFile=veffFile: {
+                "expressions": pythoniseExpressionSystem(veffFileLines(veffFile)),
+                "fileName": veffFile,
+            }
+            for veffFile, name in veffSectionNames.items()
         },
-        "vectorMassesSquared": {
-            "expressions": pythoniseExpressionSystemArray(
-                getLines(args.vectorMassesSquaredFile), allSymbols
-            ),
-            "fileName": args.vectorMassesSquaredFile,
+        "scalarMassMatrices": lambda: {
+            "expressions": pythoniseExpressionSystem(getLines(args.scalarMassMatrixFile)),
+            "fileName": args.scalarMassMatrixFile,
         },
-        "vectorShortHands": {
-            "expressions": pythoniseExpressionSystemArray(
-                getLines(args.vectorShortHandsFile), allSymbols
+        "hoistedScalarMassMatrices": lambda: {
+            "expressions": pythoniseExpressionSystem(
+                getLines(args.scalarMassMatrixFile), hoist
             ),
-            "fileName": args.vectorShortHandsFile,
-        },
-        "veff": {
-            "expressions": pythoniseExpressionSystem(veffLines),
-            "fileName": "Combined Veff files",
-        },
-        
-        "scalarMassMatrices": {
-            "expressions":pythoniseExpressionSystem(getLines(args.scalarMassMatrixFile)),
-            "fileName": args.scalarMassMatrixFile
+            "fileName": args.scalarMassMatrixFile,
         },
-        
-        
-        
+        "veffArray": lambda: pythoniseArraySystem(
+            veffLines, hoistedSymbols, "Combined Veff files", args.bCSE, hoist
+        ),
+    }
+    expressionDict = {}
+    for name, build in builders.items():
+        if name in sectionFiles:
+            expressionDict[name] = build() if name in staleSections else previous[name]
+
+    if bGradients:
+        gradients = (
+            pythoniseGradients(
+                veffLines,
+                vectorLines,
+                getLines(args.scalarMassMatrixFile),
+                lagranianVariables["fieldSymbols"],
+                scalarMassNames,
+                scalarRotationMatrix.keys(),
+                hoistedSymbols,
+                args.bCSE,
+                hoist,
+            )
+            if "veffPartials" in staleSections
+            else previous
+        )
+        expressionDict |= {name: gradients[name] for name in gradientSectionNames}
+
+    if args.bHoist:
+        if "fieldIndependent" in staleSections:
+            expressionSystem, temporaries = pythoniseSympyArray(
+                [str(symbol) for symbol in coefficients.values()],
+                list(coefficients),
+                hoistedSymbols,
+                args.bCSE,
+            )
+            expressionDict["fieldIndependent"] = {
+                "expressions": expressionSystem,
+                "temporaries": temporaries,
+                "fileName": "Field independent coefficients",
+            }
+        else:
+            expressionDict["fieldIndependent"] = previous["fieldIndependent"]
+            hoistedSymbols = allSymbols + [
+                expression["identifier"]
+                for expression in previous["fieldIndependent"]["expressions"]
+            ]
+
+    expressionDict |= {
         "scalarRotationMatrix": {
             "scalarRotationMatrix": scalarRotationMatrix,
             "fileName": args.scalarRotationMatrixFile,
@@ -179,11 +852,11 @@ def pythoniseMathematica(args):
             "fileName": args.allSymbolsFile,
         },
         "lagranianVariables": {
-            "lagranianVariables": getLinesJSON(args.lagranianVariablesFile),
+            "lagranianVariables": lagranianVariables,
             "fileName": args.lagranianVariablesFile 
         },
         "scalarMassNames": {
-            "scalarMassNames": getLinesJSON(args.scalarMassNamesFile),
+            "scalarMassNames": scalarMassNames,
             "fileName": args.scalarMassNamesFile 
         },
     }
@@ -193,26 +866,54 @@ def pythoniseMathematica(args):
         if args.scalarPermutationMatrixFile.lower() == "none"
         else getLinesJSON(args.scalarPermutationMatrixFile)
     )
-    
+
+    ## Generated last as Veff takes every symbol, including the coefficients
     if args.bCython:
-        generate_veff_module(args, allSymbols)
-        compile_veff_submodule(args)    
-    
-    else:
-        expressionDict["veffArray"] = {
-            "expressions": pythoniseExpressionSystemArray(veffLines, allSymbols),
-            "fileName": "Combined Veff files",
-        }
+        ## The cse is done per loop order as each order is its own submodule,
+        ## otherwise the submodules are generated from the Mathematica files unless
+        ## the tree level potential is in Horner form
+        veffSystems = (
+            [
+                pythoniseArraySystem(
+                    veffFileLines(veffFile),
+                    allSymbols,
+                    veffFile,
+                    args.bCSE,
+                )
+                for veffFile in veffFiles
+            ]
+            if args.bCSE or args.bHorner
+            else None
+        )
+        generate_veff_module(args, hoistedSymbols, veffSystems)
+        ## The other systems are compiled (and cached) alongside the Veff submodules
+        generate_cython_systems(expressionDict, hoistedSymbols)
+        compile_veff_submodule(
+            args,
+            list(chain(*[expressionDict[name]["expressions"] for name in veffSectionNames.values()])),
+            hoistedSymbols,
+        )
 
-    (outputFile := Path(args.pythonisedExpressionsFile)).parent.mkdir(
-        exist_ok=True, parents=True
-    )   
-    with open(outputFile, "w") as fp:
-        json.dump(expressionDict, fp, indent=4)
-    
+    ## Fuse each array system into one function so evaluating it is a single call
+    for name in arraySystemNames:
+        if name in expressionDict:
+            expressionDict[name]["function"] = pythoniseFunction(
+                name,
+                expressionDict[name]["expressions"],
+                expressionDict[name].get("temporaries", ()),
+            )
+
+    expressionDict["inputHashes"] = inputHashes
+
+    writeModelFile(expressionDict, args.pythonisedExpressionsFile)
+    if isinstance(previous, ModelFile):
+        previous.close()
+
+    parsedLines.clear()
 
 
 from unittest import TestCase
+from types import SimpleNamespace
 
 
 class PythoniseMathematicaUnitTests(TestCase):
@@ -277,3 +978,216 @@ class PythoniseMathematicaUnitTests(TestCase):
 
         self.assertEqual(reference, pythoniseMatrix(source))
 
+    def test_pythoniseFunction(self):
+        reference = (
+            "def system(params):\n"
+            "    p0 = params[0]\n"
+            "    p12 = params[12]\n"
+            "    return (\n"
+            "        sqrt(p12) + log(p0),\n"
+            "        2*p12,\n"
+            "    )\n"
+        )
+
+        source = [
+            {"expression": "sqrt(params[12]) + log(params[0])"},
+            {"expression": "2*params[12]"},
+        ]
+
+        self.assertEqual(reference, pythoniseFunction("system", source))
+
+    def test_pythoniseExpressionSystemArrayCSE(self):
+        reference = (
+            [
+                {"identifier": "a", "expression": "cse0 + 1", "symbols": ["b", "c"]},
+                {"identifier": "b", "expression": "2*cse0", "symbols": ["b", "c"]},
+            ],
+            [{"identifier": "cse0", "expression": "sqrt(params[1])*log(params[2])"}],
+        )
+
+        source = ["a -> Sqrt[b] * Log[c] + 1", "b -> 2 * Sqrt[b] * Log[c]"]
+
+        self.assertEqual(
+            reference, pythoniseExpressionSystemArrayCSE(source, ["a", "b", "c"])
+        )
+
+    def test_pythoniseGradients(self):
+        reference = {
+            "veffPartials": [
+                {
+                    "identifier": "v",
+                    "expression": "2*params[0]*params[1]",
+                    "symbols": ["mV", "v"],
+                },
+                {"identifier": "mV", "expression": "params[0]**2", "symbols": ["v"]},
+                {
+                    "identifier": "MS",
+                    "expression": "1/(2*sqrt(params[2]))",
+                    "symbols": ["MS"],
+                },
+            ],
+            "vectorMassesJacobian": [
+                {
+                    "identifier": "mV",
+                    "expression": "2*params[0]*params[3]**2",
+                    "symbols": ["g", "v"],
+                },
+            ],
+            "scalarMassMatricesJacobian": [
+                {
+                    "identifier": "v",
+                    "expression": "(((2*v, 0), (0, 0)),)",
+                    "symbols": ["v"],
+                },
+            ],
+        }
+
+        source = pythoniseGradients(
+            ["v^2 * mV + Sqrt[MS]"],
+            ["mV -> g^2 v^2"],
+            ["{{v^2, g}, {g, 1}}"],
+            ["v"],
+            ["MS"],
+            [],
+            ["v", "mV", "MS", "g"],
+            False,
+        )
+
+        self.assertEqual(
+            reference, {name: system["expressions"] for name, system in source.items()}
+        )
+
+    def test_hoistFieldIndependent(self):
+        reference = (
+            "coeff0*v + coeff1*v**2 + coeff1",
+            {"coeff0": "sqrt(a)", "coeff1": "a*b"},
+            ["v", "a", "b", "coeff0", "coeff1"],
+        )
+
+        coefficients, allSymbols = {}, ["v", "a", "b"]
+        source = hoistFieldIndependent(
+            parseLine("a*b*v^2 + Sqrt[a]*v + a*b")[1],
+            {Symbol("v")},
+            coefficients,
+            allSymbols,
+        )
+
+        self.assertEqual(
+            reference,
+            (
+                str(source),
+                {
+                    str(symbol): str(expression)
+                    for expression, symbol in coefficients.items()
+                },
+                allSymbols,
+            ),
+        )
+
+    def test_hornerForm(self):
+        reference = [
+            "v*(a + v*(b*c + b*v))",
+            "((a*v**2, b), (b, a + c))",
+            "a*sqrt(v) + a*v**2",
+        ]
+
+        source = [
+            parseLine("a*v + b*c*v^2 + b*v^3")[1],
+            parseLine("{{a*v^2, b}, {b, a + c}}")[1],
+            parseLine("a*v^2 + Sqrt[v]*a")[1],
+        ]
+
+        self.assertEqual(
+            reference, [str(hornerForm(expression, [Symbol("v")])) for expression in source]
+        )
+
+    def test_splitSummands(self):
+        reference = [
+            ["a*(b + c) ", "- d^(-2) ", "+ f[x - y]*-g"],
+            ["a ", "- b^-2 ", "+ c"],
+        ]
+
+        source = ["a*(b + c) - d^(-2) + f[x - y]*-g", "a - b^-2 + c"]
+
+        self.assertEqual(reference, [splitSummands(string, 1) for string in source])
+
+    def test_streamSummands(self):
+        reference = ["a*(b + c) ", "- d ", "+ f[x - y]*-g", "h ", "+ i"]
+
+        source = "a*(b + c) - d + f[x - y]*-g\nh + i\n\n"
+
+        ## Small blocks so terms and brackets span blocks
+        self.assertEqual(
+            reference, list(streamSummands(StringIO(source), 2, blockSize=3))
+        )
+
+    def test_streamSummandsExponent(self):
+        ## A signed exponent early in a long line doesn't stop the rest being split
+        source = "a^-1*b + c - d^-(e + f) + " + " + ".join(f"x{idx}" for idx in range(10))
+        chunks = list(streamSummands(StringIO(source), 1))
+
+        self.assertEqual(["a^-1*b ", "+ c ", "- d^-(e + f) ", "+ x0 "], chunks[:4])
+        self.assertEqual(13, len(chunks))
+        self.assertEqual(
+            parseMathematicaString(source),
+            Add(*[parseMathematicaString(chunk) for chunk in chunks]),
+        )
+        self.assertEqual(
+            parseMathematicaString("a^(-1)*b + c - d^(-(e + f))"),
+            parseMathematicaString("a^-1*b + c - d^-(e + f)"),
+        )
+
+    def test_parseLines(self):
+        reference = parseMathematicaString("Sqrt[a] + b*(a - 1) - a^(-2) + 3*b")
+
+        source = "Identifier -> Sqrt[a] + b*(a - 1) - a^(-2) + 3*b"
+
+        parseLines([source], chunkLength=1)
+        self.assertEqual(("Identifier", reference), parsedLines.pop(source))
+
+    def test_hashInputs(self):
+        source = ["Data/Z2_3HDM/ModelFiles/Misc/bounded.txt"]
+
+        self.assertEqual(
+            hashInputs(source, {"bCSE": False}), hashInputs(source, {"bCSE": False})
+        )
+        self.assertNotEqual(
+            hashInputs(source, {"bCSE": False}), hashInputs(source, {"bCSE": True})
+        )
+        self.assertNotEqual(
+            hashInputs(source, {"bCSE": False}),
+            hashInputs(source, {"bCSE": False}, version=converterVersion + "-next"),
+        )
+
+    def test_staleSectionNames(self):
+        source = ["Data/Z2_3HDM/ModelFiles/Misc/bounded.txt"]
+        sectionNames = ("bounded", "veffLO", "veffArray", "vectorShortHands")
+
+        def hashes(**flags):
+            args = SimpleNamespace(
+                **{"bCSE": False, "bHoist": False, "bStreamVeff": False, "bHorner": False}
+                | flags
+            )
+            return {
+                name: hashInputs(source, sectionArgs(name, args, sectionNames))
+                for name in sectionNames
+            }
+
+        previous = {name: {} for name in sectionNames} | {"inputHashes": hashes()}
+
+        self.assertEqual(set(), staleSectionNames(hashes(), previous, False))
+        ## The tree level isn't streamed, so only the combined Veff is rebuilt
+        self.assertEqual(
+            {"veffArray"}, staleSectionNames(hashes(bStreamVeff=True), previous, False)
+        )
+        self.assertEqual(
+            {"veffLO", "veffArray"},
+            staleSectionNames(hashes(bHorner=True), previous, False),
+        )
+        self.assertEqual(
+            {"bounded", "veffArray", "vectorShortHands"},
+            staleSectionNames(hashes(bCSE=True), previous, False),
+        )
+        self.assertEqual(
+            {"veffArray"}, staleSectionNames(hashes(bHoist=True), previous, True)
+        )
@@ -5,6 +5,7 @@ import scipy
 from dataclasses import dataclass, InitVar, field
 
 from Bloop.PDGData import mTop, mW, mZ, higgsVEV
+from Bloop.Profiler import Profiler
 
 
 def bIsPerturbative(params, pertSymbols, allSymbols):
@@ -31,12 +32,15 @@ class TrackVEV:
     bounded: str = "bounded"
 
     verbose: bool = False
+    bCheckStability: bool = False
 
     EulerGammaPrime = 2.0 * (log(4.0 * pi) - np.euler_gamma)
     Lfconst = 4.0 * log(2.0)
 
     allSymbols: list = field(default_factory=list)
 
+    profiler: Profiler = field(default_factory=Profiler)
+
     config: InitVar[dict] = None
 
     def __post_init__(self, config):
@@ -52,6 +56,9 @@ class TrackVEV:
             "bIsPerturbative": [],
             "failureReason": False,
         }
+        ## The Hessian costs a few Veff evaluations per temperature so is opt in
+        if self.bCheckStability:
+            minimizationResults["bIsStable"] = []
 
         params = self.getLagranianParams4D(benchmark)
 
@@ -74,12 +81,13 @@ class TrackVEV:
             ):
                 return np.real(self.betaFunction4DExpression.evaluate(initialConditions) / mu)
                 
-        solvedBetaFunction = scipy.integrate.solve_ivp(
-            betaFunction,
-            (muRange[0], muRange[-1]),
-            params,
-            t_eval=muRange
-        )
+        with self.profiler.timer("RG solve"):
+            solvedBetaFunction = scipy.integrate.solve_ivp(
+                betaFunction,
+                (muRange[0], muRange[-1]),
+                params,
+                t_eval=muRange
+            )
         
         if not solvedBetaFunction.success:
             return minimizationResults | {"failureReason":  solvedBetaFunction.message}
@@ -101,6 +109,8 @@ class TrackVEV:
             if self.verbose:
                 print(f"Start of temp = {T} loop")
 
+            self.profiler.setTemperature(T)
+
             params = self.runParams4D(betaSpline4D, T)
 
             if not np.all(self.bounded.evaluateUnordered(params)):
@@ -123,6 +133,10 @@ class TrackVEV:
             minimizationResults["vevDepthImag"].append(vevDepth.imag)
             minimizationResults["vevLocation"].append(vevLocation)
             minimizationResults["bIsPerturbative"].append(isPert)
+            if self.bCheckStability:
+                minimizationResults["bIsStable"].append(
+                    self.effectivePotential.bIsStable(vevLocation, T, params)
+                )
 
             if np.all(np.abs(vevLocation) < 0.5):
                 if self.verbose:
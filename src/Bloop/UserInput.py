@@ -36,6 +36,70 @@ class UserInput(argparse.ArgumentParser):
             help="Bool: If activated code will use cython to compile Veff EXPERIMENTAL"
         )
 
+        self.add_argument(
+            "--cythonProfile",
+            action="store",
+            default="default",
+            choices=["default", "O3", "native", "fastMath", "pgo"],
+            help="Str: Compiler flags used to build the cython modules, pgo trains the build on sample points. Each build is checked against python for accuracy and throughput",
+        )
+
+        self.add_argument(
+            "--cythonCompiler",
+            action="store",
+            default=None,
+            help="Str: C compiler used to build the cython modules (e.g. clang), the one python was built with by default",
+        )
+
+        self.add_argument(
+            "--bNumba",
+            action="store_true",
+            default=False,
+            help="Bool: If activated code will use numba to compile the expression systems",
+        )
+
+        self.add_argument(
+            "--bRealFastPath",
+            action="store_true",
+            default=False,
+            help="Bool: If activated the minimiser evaluates Veff in real arithmetic, only switching to complex where needed",
+        )
+
+        self.add_argument(
+            "--bWarmStartEigen",
+            action="store_true",
+            default=False,
+            help="Bool: If activated the scalar mass matrices are diagonalised with Jacobi sweeps starting from the eigenvectors of the previous point, falling back to a full diagonalisation for (near) degenerate masses",
+        )
+
+        self.add_argument(
+            "--bCSE",
+            action="store_true",
+            default=False,
+            help="Bool: If activated common subexpressions are shared between expressions when converting Mathematica",
+        )
+
+        self.add_argument(
+            "--bStreamVeff",
+            action="store_true",
+            default=False,
+            help="Bool: If activated the potential files are read and parsed in chunks of terms (summed when Veff is evaluated) rather than whole lines, bounding the memory needed to convert large potentials",
+        )
+
+        self.add_argument(
+            "--bHorner",
+            action="store_true",
+            default=False,
+            help="Bool: If activated the tree level potential, vector masses and scalar mass matrices are written in Horner form in the fields when converting Mathematica",
+        )
+
+        self.add_argument(
+            "--bHoist",
+            action="store_true",
+            default=False,
+            help="Bool: If activated the field independent parts of Veff and the masses are computed once per temperature rather than at every field point",
+        )
+
 
         self.add_argument(
             "--loopOrder",
@@ -58,7 +122,7 @@ class UserInput(argparse.ArgumentParser):
             "--bPool",
             action="store_true",
             default=False,
-            help="Bool: If activated code will run in parallel using number of cores set by --cores",
+            help="Bool: If activated code (benchmarks and parsing Mathematica) will run in parallel using number of cores set by --cores",
         )
 
         self.add_argument(
@@ -67,7 +131,7 @@ class UserInput(argparse.ArgumentParser):
             default=1,
             choices=list(range(1, multiprocessing.cpu_count() + 1)),
             type=int,
-            help="Int: Specify how many cores pool uses to compute benchmarks",
+            help="Int: Specify how many cores pool uses to compute benchmarks and parse Mathematica",
         )
 
         self.add_argument(
@@ -84,6 +148,13 @@ class UserInput(argparse.ArgumentParser):
             help="Bool: If activated a plot of the global min of the potential vs T is made",
         )
 
+        self.add_argument(
+            "--bProfile",
+            action="store_true",
+            default=False,
+            help="Bool: If activated calls and time spent in each expression system, mass computation and nlopt are saved next to the results",
+        )
+
         self.add_argument(
             "--bProcessMin",
             action="store_true",
@@ -114,6 +185,28 @@ class UserInput(argparse.ArgumentParser):
             "--relLocalTolerance", action="store", default=1e-3, type=float
         )
 
+        self.add_argument(
+            "--localMethod",
+            action="store",
+            default="LN_BOBYQA",
+            choices=["LN_BOBYQA", "LD_LBFGS", "LD_SLSQP"],
+            help="Str: nlopt local minimiser, LD_ methods use the analytic gradient of Veff (generated when converting Mathematica)",
+        )
+
+        self.add_argument(
+            "--bNewtonPolish",
+            action="store_true",
+            default=False,
+            help="Bool: If activated the minimum found by nlopt is refined with Newton steps using the gradient and Hessian of Veff (generated when converting Mathematica)",
+        )
+
+        self.add_argument(
+            "--bCheckStability",
+            action="store_true",
+            default=False,
+            help="Bool: If activated each result records bIsStable, whether the Hessian of Veff at the minimum is positive definite",
+        )
+
         self.add_argument(
             "--varLowerBounds",
             nargs="*",
@@ -304,7 +397,7 @@ class UserInput(argparse.ArgumentParser):
         self.add_argument(
             "--pythonisedExpressionsFile",
             action="store",
-            default="Bloop/Data/Z2_3HDM/pythonisedExpressionsFile.json",
+            default="Bloop/Data/Z2_3HDM/pythonisedExpressionsFile.bin",
         )
 
     noMetaVar = {"store_true", "store_false", "help", "version"}
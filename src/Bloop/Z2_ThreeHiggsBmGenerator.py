@@ -10,6 +10,7 @@ from pathlib import Path
 from os.path import join
 from glob import glob
 
+from Bloop.ModelFile import ModelFile
 from Bloop.ParsedExpression import ParsedExpression
 from Bloop.EffectivePotential import cNlopt
 from Bloop.PDGData import mHiggs, higgsVEV
@@ -301,16 +302,16 @@ def generateBenchmarks(args):
             "varUpperBounds": [300, 300, 300],
         }
     )
-    with open(args.pythonisedExpressionsFile, "r") as fp:
-        parsedExpressions = json.load(fp)
-    ## Take the pythonised tree level potential we've generated
-    treeLevel = ParsedExpression(parsedExpressions["veff"]["expressions"][0], None)
-    chargedMassMatrix = ParsedExpression(
-        parsedExpressions["scalarMassMatrices"]["expressions"][0], None
-    )
-    neutralMassMatrix = ParsedExpression(
-        parsedExpressions["scalarMassMatrices"]["expressions"][1], None
-    )
+    ## Only the sections used here are loaded from the model file
+    with ModelFile(args.pythonisedExpressionsFile) as parsedExpressions:
+        ## Take the pythonised tree level potential we've generated
+        treeLevel = ParsedExpression(parsedExpressions["veffLO"]["expressions"][0], None)
+        chargedMassMatrix = ParsedExpression(
+            parsedExpressions["scalarMassMatrices"]["expressions"][0], None
+        )
+        neutralMassMatrix = ParsedExpression(
+            parsedExpressions["scalarMassMatrices"]["expressions"][1], None
+        )
 
     ## Feels weird to have nested function but not sure how else to go until can
     ## use arrays with nlopt
@@ -453,3 +454,28 @@ class BmGeneratorUnitTests(TestCase):
             0,
         )
         self.assertEqual(reference, _lagranianParamGen(*source))
+
+    def test_generateBenchmarksHoisted(self):
+        from tempfile import TemporaryDirectory
+        from Bloop.UserInput import UserInput
+        from Bloop.PythoniseMathematica import pythoniseMathematica
+
+        with TemporaryDirectory() as directory:
+            args = UserInput().parse_args(
+                [
+                    "--loopOrder", "1",
+                    "--bHoist",
+                    "--pythonisedExpressionsFile", join(directory, "model.json"),
+                    "--benchmarkFile", join(directory, "handPicked.json"),
+                    "--benchmarkType", "handPicked",
+                ]
+            )
+            pythoniseMathematica(args)
+            ## The potential's mass matrices are hoisted, the generator's aren't
+            with ModelFile(args.pythonisedExpressionsFile) as modelFile:
+                self.assertIn("coeff", str(modelFile["hoistedScalarMassMatrices"]))
+                self.assertNotIn("coeff", str(modelFile["scalarMassMatrices"]))
+
+            generateBenchmarks(args)
+            with open(args.benchmarkFile, "r") as fp:
+                self.assertEqual(8, len(json.load(fp)))
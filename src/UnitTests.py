@@ -5,6 +5,12 @@ if __name__ == "__main__":
     from Bloop.TransitionFinder import TransitionFinderUnitTests # noqa: F401
     from Bloop.Z2_ThreeHiggsBmGenerator import BmGeneratorUnitTests # noqa: F401
     from Bloop.PDGData import PDGUnitTests # noqa: F401
+    from Bloop.Profiler import ProfilerUnitTests # noqa: F401
+    from Bloop.ModelFile import ModelFileUnitTests # noqa: F401
+    from Bloop.EffectivePotential import EffectivePotentialUnitTests # noqa: F401
+    from Veff_generation.generate_numba_module import NumbaModuleUnitTests # noqa: F401
+    from Veff_generation.generate_veff_module import VeffModuleUnitTests # noqa: F401
+    from Veff_generation.generate_cython_systems import CythonSystemsUnitTests # noqa: F401
 
     from unittest import main
 
@@ -1,2 +1,4 @@
 from .generate_veff_module import *
-from .compile_veff_module import *
\ No newline at end of file
+from .generate_cython_systems import *
+from .compile_veff_module import *
+from .generate_numba_module import *
\ No newline at end of file
@@ -1,36 +1,242 @@
 import os
 import sys
+import json
 import time
+import shutil
+import sysconfig
 import subprocess
+import tempfile
+from glob import glob
+from hashlib import sha256
 
-def compile_veff_submodule(args):
+import Cython
+import numpy as np
+
+## Compiler flags of each build profile, pgo is also trained on sample points
+## before being rebuilt with the profile it records
+buildProfiles = {
+    "default": [],
+    "O3": ["-O3"],
+    "native": ["-O3", "-march=native"],
+    "fastMath": ["-O3", "-march=native", "-ffast-math"],
+    "pgo": ["-O3", "-march=native"],
+}
+
+## Largest relative difference from the python evaluator a build may have
+buildTolerance = 1e-8
+
+def compile_veff_submodule(args, veffExpressions=None, allSymbols=None):
+    """veffExpressions (the pythonised veff system) and allSymbols, if given, are
+    used to check the accuracy and throughput of a new build against python"""
     parent_dir = os.path.dirname(os.getcwd())
     module_dir = os.path.join(parent_dir, 'src', 'Bloop', 'Veff')
     setup_path = os.path.join(module_dir, "setup.py")
-    
+    cache_dir  = os.path.join(module_dir, "cache")
+
     if not os.path.isfile(setup_path):
         raise FileNotFoundError(f"No setup.py found in {module_dir}")
-    
-    if args.verbose:
-        print("Compiling Veff submodule")
-    
-    ti = time.time()
+
+    compiler = args.cythonCompiler or sysconfig.get_config_var("CC").split()[0]
+    flags = buildProfiles[args.cythonProfile]
+
+    ## Only Veff is checked against python, so the other systems are always built
+    ## with the default flags rather than risk an unchecked (e.g. fastMath) build
+    def moduleProfile(name):
+        return "default" if name == "systems" else args.cythonProfile
+
+    ## Compiled modules are cached by a hash of their source, so a rerun with an
+    ## unchanged model (or an unchanged part of the model) skips compiling them
+    suffix = sysconfig.get_config_var("EXT_SUFFIX")
+    cachedModules = {
+        name: os.path.join(
+            cache_dir,
+            f"{name}-{buildKey(module_dir, name, moduleProfile(name), compiler)}{suffix}",
+        )
+        for name in [
+            os.path.splitext(os.path.basename(pyx))[0]
+            for pyx in sorted(glob(os.path.join(module_dir, "*.pyx")))
+        ]
+    }
+    uncached = [name for name, cached in cachedModules.items() if not os.path.isfile(cached)]
+    uncachedVeff = [name for name in uncached if moduleProfile(name) == args.cythonProfile]
+    uncachedDefault = [name for name in uncached if name not in uncachedVeff]
+
+    if uncached:
+        if args.verbose:
+            print(f"Compiling Veff submodule ({len(uncached)} of {len(cachedModules)} modules not cached) with the {args.cythonProfile} profile")
+
+        ti = time.time()
+        if uncachedDefault:
+            buildModules(args, module_dir, uncachedDefault, compiler, buildProfiles["default"])
+        for name, cached in cachedModules.items():
+            if name not in uncached:
+                shutil.copy2(cached, os.path.join(module_dir, f"{name}{suffix}"))
+        if uncachedVeff and args.cythonProfile == "pgo":
+            with tempfile.TemporaryDirectory() as profileDir:
+                ## Instrumented build, trained with every module in place
+                buildModules(args, module_dir, uncachedVeff, compiler, flags + [f"-fprofile-generate={profileDir}"])
+                trainModules(module_dir, profileDir, samplePoints(len(allSymbols)))
+                buildModules(args, module_dir, uncachedVeff, compiler, flags + profileUseFlags(compiler, profileDir))
+        elif uncachedVeff:
+            buildModules(args, module_dir, uncachedVeff, compiler, flags)
+        tf = time.time()
+
+        if args.verbose:
+            print(f'Compilation took {tf - ti} seconds.')
+
+        ## Checked in place before caching, so a build that fails is never reused
+        if veffExpressions:
+            report = checkBuild(veffExpressions, allSymbols)
+            report |= {"profile": args.cythonProfile, "compiler": compiler, "flags": flags}
+            with open(os.path.join(module_dir, "buildReport.json"), "w") as fp:
+                json.dump(report, fp, indent=4)
+
+            if args.verbose:
+                print(f"Cython build check: {report}")
+
+            if not report["relativeDifference"] <= buildTolerance:
+                for name in cachedModules:
+                    os.remove(os.path.join(module_dir, f"{name}{suffix}"))
+                raise RuntimeError(
+                    f"The {args.cythonProfile} build of Veff differs from python by "
+                    f"{report['relativeDifference']} (more than {buildTolerance}), use a safer --cythonProfile"
+                )
+
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in uncached:
+            shutil.copy2(os.path.join(module_dir, f"{name}{suffix}"), cachedModules[name])
+
+    else:
+        if args.verbose:
+            print("Veff submodule is cached, skipping compilation")
+
+        for name, cached in cachedModules.items():
+            shutil.copy2(cached, os.path.join(module_dir, f"{name}{suffix}"))
+
+    ## Only the builds of this conversion are kept, otherwise every changed model
+    ## or profile would leave its modules in the cache
+    for cached in glob(os.path.join(cache_dir, f"*{suffix}")):
+        if cached not in cachedModules.values():
+            os.remove(cached)
+
+    # TODO: Add a clean up step to remove any compilation artifacts.
+
+
+def buildModules(args, module_dir, names, compiler, flags):
+    ## --force as setuptools skips extensions newer than their source, i.e. the
+    ## instrumented build of pgo
+    environment = os.environ | {
+        "VEFF_MODULES": " ".join(names),
+        "VEFF_THREADS": str(args.cores),
+        "VEFF_CFLAGS": " ".join(flags),
+    }
+    if args.cythonCompiler:
+        environment |= {"CC": compiler, "LDSHARED": f"{compiler} -shared"}
+
     result = subprocess.run(
-        [sys.executable, "setup.py", "build_ext", "--inplace"],
+        [sys.executable, "setup.py", "build_ext", "--inplace", "--force", "--parallel", str(args.cores)],
         cwd=module_dir,
         capture_output=True,
         text=True,
+        env=environment,
     )
-    tf = time.time()
 
     if result.returncode != 0:
         print("Compilation failed:")
         print(result.stderr)
         raise RuntimeError("Cython build failed")
-    else:
-        if args.verbose:        
-            print("Cython compilation succeeded:")
-            print(result.stdout)
-            print(f'Compilation took {tf - ti} seconds.')
-        
-    # TODO: Add a clean up step to remove any compilation artifacts.
+    elif args.verbose:
+        print("Cython compilation succeeded:")
+        print(result.stdout)
+
+
+def profileUseFlags(compiler, profileDir):
+    ## gcc reads the .gcda files directly, clang's raw profiles need merging first.
+    ## Counters from the OpenMP threads race so gcc has to correct them
+    if "clang" not in os.path.basename(compiler):
+        return [f"-fprofile-use={profileDir}", "-fprofile-correction"]
+
+    profileData = os.path.join(profileDir, "veff.profdata")
+    subprocess.run(
+        ["llvm-profdata", "merge", f"-output={profileData}", *glob(os.path.join(profileDir, "*.profraw"))],
+        check=True,
+    )
+    return [f"-fprofile-use={profileData}"]
+
+
+def trainModules(module_dir, profileDir, points):
+    ## Run in a new process as the instrumented modules are replaced afterwards
+    ## and the profile is only written when the process exits
+    pointsFile = os.path.join(profileDir, "points.npy")
+    np.save(pointsFile, points)
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, numpy as np\n"
+            "from Bloop.Veff import Veff, VeffBatch\n"
+            "points = np.load(sys.argv[1])\n"
+            "VeffBatch(points)\n"
+            "for point in points:\n"
+            "    Veff(point)\n",
+            pointsFile,
+        ],
+        cwd=os.path.dirname(os.path.dirname(module_dir)),
+        check=True,
+    )
+
+
+def samplePoints(nSymbols, nPoints=64):
+    ## Params of order one, seeded so builds are trained and checked on the same points
+    return np.random.default_rng(0).uniform(0.1, 1, (nPoints, nSymbols)).astype(np.complex128)
+
+
+def checkBuild(veffExpressions, allSymbols, duration=1):
+    """Accuracy (largest difference relative to the size of Veff) and throughput
+    (points per second) of the compiled Veff against the python evaluator"""
+    from Bloop.ParsedExpression import ParsedExpressionSystem
+    from Bloop.Veff import Veff
+
+    pythonVeff = ParsedExpressionSystem(veffExpressions, "Veff")
+    points = samplePoints(len(allSymbols))
+
+    def pythonValue(point):
+        return sum(pythonVeff.evaluate(dict(zip(allSymbols, point))))
+
+    differences = [
+        abs(Veff(point) - reference) / abs(reference)
+        for point, reference in zip(points, map(pythonValue, points))
+    ]
+
+    def throughput(function):
+        calls, start = 0, time.perf_counter()
+        while time.perf_counter() - start < duration:
+            function(points[calls % len(points)])
+            calls += 1
+        return calls / (time.perf_counter() - start)
+
+    return {
+        "relativeDifference": float(max(differences)),
+        "pointsPerSecond": throughput(Veff),
+        "pythonPointsPerSecond": throughput(pythonValue),
+    }
+
+
+def buildKey(module_dir, name, profile, compiler):
+    ## The module's source, the build script, the profile and the compiler/toolchain
+    digest = sha256()
+    for fileName in (f"{name}.pyx", "setup.py"):
+        with open(os.path.join(module_dir, fileName), "rb") as file:
+            digest.update(file.read())
+    digest.update(json.dumps([
+        profile,
+        buildProfiles[profile],
+        compiler,
+        sys.version,
+        Cython.__version__,
+        sysconfig.get_config_var("CC"),
+        sysconfig.get_config_var("CFLAGS"),
+        os.environ.get("CC", ""),
+        os.environ.get("CFLAGS", ""),
+    ]).encode())
+    return digest.hexdigest()[:16]
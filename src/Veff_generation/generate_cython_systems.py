@@ -0,0 +1,239 @@
+import ast
+import os
+import re
+from textwrap import dedent
+from jinja2 import Environment
+
+from .generate_veff_module import complexArraySource
+
+## Array systems (params[idx] in, one value per expression out) compiled by the
+## cython backend, bounded is left out as it compares values. Veff has its own modules
+cythonArraySystemNames = (
+    "betaFunctions4D",
+    "hardToSoft",
+    "softScaleRGE",
+    "softToUltraSoft",
+    "vectorMassesSquared",
+    "vectorShortHands",
+    "veffPartials",
+    "vectorMassesJacobian",
+    "fieldIndependent",
+)
+
+## Named systems whose expressions are (nested tuples of) matrices, the compiled
+## version takes params indexed like allSymbols and returns one array of them all
+cythonTensorSystemNames = (
+    "scalarMassMatrices",
+    "hoistedScalarMassMatrices",
+    "scalarMassMatricesJacobian",
+)
+
+
+def generate_cython_systems(pythonisedExpressions, allSymbols, module_dir=None):
+    """Write systems.pyx next to the Veff submodules (so it's compiled and cached
+    with them), or into module_dir, with a compiled function for each expression
+    system. Returns the path of systems.pyx"""
+    if module_dir is None:
+        parent_dir = os.path.dirname(os.getcwd())
+        module_dir = os.path.join(parent_dir, 'src', 'Bloop', 'Veff')
+    pyxPath = os.path.join(module_dir, 'systems.pyx')
+
+    systems = [
+        cythoniseArraySystem(name, pythonisedExpressions[name])
+        for name in cythonArraySystemNames
+        if name in pythonisedExpressions
+    ] + [
+        cythoniseTensorSystem(name, pythonisedExpressions[name], allSymbols)
+        for name in cythonTensorSystemNames
+        if name in pythonisedExpressions
+    ]
+
+    with open(pyxPath, 'w') as file:
+        file.write(Environment().from_string(dedent("""\
+            #cython: cdivision=False, boundscheck=False, wraparound=False
+            import numpy as np
+            from libc.complex cimport csqrt
+            from libc.complex cimport clog
+
+
+            {{ complexArraySource }}
+            {%- for system in systems %}
+
+            def {{ system.name }}(params):
+                cdef const double complex[::1] p = complexArray(params)
+                cdef double complex[{{ system.memoryview }}] out = np.zeros({{ system.shape }}, dtype=np.complex128)
+            {%- for identifier, expression in system.temporaries %}
+                cdef double complex {{ identifier }} = {{ expression }}
+            {%- endfor %}
+            {%- for index, expression in system.expressions %}
+                out[{{ index }}] = {{ expression }}
+            {%- endfor %}
+                return np.asarray(out)
+            {% endfor %}
+            """)).render(systems=systems, complexArraySource=complexArraySource))
+
+    return pyxPath
+
+
+def cythoniseArraySystem(name, system):
+    def cythonise(expression):
+        expression = re.sub(r"params\[(\d+)\]", r"p[\1]", expression)
+        expression = re.sub(r"\blog\(", "clog(", expression)
+        return re.sub(r"\bsqrt\(", "csqrt(", expression)
+
+    return {
+        "name": name,
+        "memoryview": "::1",
+        "shape": len(system["expressions"]),
+        "temporaries": [
+            (temporary["identifier"], cythonise(temporary["expression"]))
+            for temporary in system.get("temporaries", [])
+        ],
+        "expressions": [
+            (idx, cythonise(expression["expression"]))
+            for idx, expression in enumerate(system["expressions"])
+        ],
+    }
+
+
+def cythoniseTensorSystem(name, system, allSymbols):
+    entries, shape = tensorEntries(system, allSymbols, {"log": "clog", "sqrt": "csqrt"})
+
+    return {
+        "name": name,
+        "memoryview": ", ".join([":"] * (len(shape) - 1) + ["::1"]),
+        "shape": shape,
+        "temporaries": [],
+        "expressions": [
+            (", ".join(map(str, index)), expression) for index, expression in entries
+        ],
+    }
+
+
+def tensorEntries(system, allSymbols, functions):
+    """(index, expression) of every entry of a system whose expressions are (nested
+    tuples of) matrices, indexed [expression, ...], and the shape of the whole system.
+    Symbols become p[idx] and functions are renamed by functions"""
+    indices = {symbol: idx for idx, symbol in enumerate(allSymbols)}
+
+    class Rename(ast.NodeTransformer):
+        def visit_Name(self, node):
+            if node.id in functions:
+                return ast.Name(functions[node.id], ast.Load())
+            return ast.parse(f"p[{indices[node.id]}]", mode="eval").body
+
+    def elements(node, index):
+        ## Entries of the nested tuples and their shape
+        if not isinstance(node, ast.Tuple):
+            return [(index, ast.unparse(Rename().visit(node)))], ()
+
+        entries = [elements(element, index + (idx,)) for idx, element in enumerate(node.elts)]
+        return [entry for entry, _ in entries for entry in entry], (len(entries),) + entries[0][1]
+
+    entries, shape = [], ()
+    for idx, expression in enumerate(system["expressions"]):
+        expressionEntries, shape = elements(
+            ast.parse(expression["expression"], mode="eval").body, (idx,)
+        )
+        entries += expressionEntries
+
+    return entries, (len(system["expressions"]),) + shape
+
+
+from unittest import TestCase
+
+
+class CythonSystemsUnitTests(TestCase):
+    def test_tensorEntries(self):
+        system = {"expressions": [{"identifier": "m", "expression": "((a, sqrt(b)), (b, log(a)))"}]}
+
+        self.assertEqual(
+            (
+                [
+                    ((0, 0, 0), "p[0]"),
+                    ((0, 0, 1), "csqrt(p[1])"),
+                    ((0, 1, 0), "p[1]"),
+                    ((0, 1, 1), "clog(p[0])"),
+                ],
+                (1, 2, 2),
+            ),
+            tensorEntries(system, ["a", "b", "m"], {"log": "clog", "sqrt": "csqrt"}),
+        )
+
+    def test_generate_cython_systems(self):
+        from tempfile import TemporaryDirectory
+        import numpy as np
+        from importlib.util import module_from_spec, spec_from_file_location
+        import subprocess
+        import sys
+        import sysconfig
+        from Bloop.ParsedExpression import ParsedExpressionSystemArray, indexSymbols
+        from Bloop.PythoniseMathematica import pythoniseFunction
+
+        allSymbols = ["a", "b", "c", "d", "m"]
+        pythonisedExpressions = {
+            "vectorMassesSquared": {
+                "expressions": [
+                    {"identifier": "c", "expression": "sqrt(params[0]) + cse0", "symbols": ["a", "b"]},
+                    {"identifier": "d", "expression": "params[0]**(3/2) * cse0 - 2", "symbols": ["a", "b"]},
+                ],
+                "temporaries": [{"identifier": "cse0", "expression": "log(params[1])/3"}],
+            },
+            "bounded": {
+                "expressions": [
+                    {"identifier": "d", "expression": "params[0] > 0", "symbols": ["a"]},
+                ],
+            },
+            "scalarMassMatrices": {
+                "expressions": [
+                    {"identifier": "m", "expression": "((a, sqrt(b)), (sqrt(b), a/2))", "symbols": ["a", "b"]},
+                    {"identifier": "m", "expression": "((log(a), 0), (0, b**2))", "symbols": ["a", "b"]},
+                ],
+            },
+        }
+        references = {
+            "vectorMassesSquared": ParsedExpressionSystemArray(
+                pythonisedExpressions["vectorMassesSquared"]["expressions"],
+                allSymbols,
+                None,
+                pythoniseFunction(
+                    "vectorMassesSquared",
+                    pythonisedExpressions["vectorMassesSquared"]["expressions"],
+                    pythonisedExpressions["vectorMassesSquared"]["temporaries"],
+                ),
+            ),
+            "scalarMassMatrices": ParsedExpressionSystemArray(
+                indexSymbols(pythonisedExpressions["scalarMassMatrices"]["expressions"], allSymbols),
+                allSymbols,
+                None,
+            ),
+        }
+        ## Negative, complex and positive params so branch cuts and imaginary parts are checked
+        paramsMatrix = np.array(
+            [[4, 9, 0, 0, 0], [-4, 2 + 1j, 0, 0, 0], [0.5 - 2j, -1, 0, 0, 0]], dtype=complex
+        )
+
+        with TemporaryDirectory() as directory:
+            pyxPath = generate_cython_systems(pythonisedExpressions, allSymbols, directory)
+            with open(pyxPath) as file:
+                source = file.read()
+            subprocess.run(
+                [sys.executable, "-m", "Cython.Build.Cythonize", "-i", "-3", pyxPath],
+                check=True,
+                capture_output=True,
+            )
+            spec = spec_from_file_location(
+                "systems", os.path.join(directory, f"systems{sysconfig.get_config_var('EXT_SUFFIX')}")
+            )
+            module = module_from_spec(spec)
+            spec.loader.exec_module(module)
+
+        ## bounded compares values so is left to python
+        self.assertNotIn("def bounded", source)
+        self.assertIn("cdef double complex cse0 = clog(p[1])/3", source)
+        self.assertIn("out[1, 0, 0] = clog(p[0])", source)
+        for name, reference in references.items():
+            for params in paramsMatrix:
+                np.testing.assert_allclose(
+                    np.asarray(reference.evaluateUnordered(params)), getattr(module, name)(params)
+                )
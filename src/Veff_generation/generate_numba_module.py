@@ -0,0 +1,250 @@
+import re
+import sys
+from pathlib import Path
+from textwrap import dedent
+from importlib.util import spec_from_file_location, module_from_spec
+from jinja2 import Environment
+
+from .generate_cython_systems import tensorEntries
+
+## Systems that the numba backend compiles, in the order they're written. bounded
+## is left in python (like the cython backend) as it compares values, which
+## numba can't do for complex numbers without dropping the imaginary parts
+numbaSystemNames = (
+    "betaFunctions4D",
+    "hardToSoft",
+    "softScaleRGE",
+    "softToUltraSoft",
+    "vectorMassesSquared",
+    "vectorShortHands",
+    "veffArray",
+    "veffPartials",
+    "vectorMassesJacobian",
+    "fieldIndependent",
+)
+
+
+def generate_numba_module(pythonisedExpressions, moduleFile, allSymbols):
+    """Write a module with an @njit function for every array system in the
+    pythonised expressions, and scalarEigenSystem which builds the scalar mass
+    matrices (indexed like allSymbols) and diagonalises them in one call.
+    scaledScalarMassMatrices only builds them (divided by T^2, as diagonalised).
+    The file is only rewritten when its contents change as numba invalidates
+    its on disk cache on the file's timestamp.
+    """
+    systems = [
+        numbaniseSystem(name, pythonisedExpressions[name])
+        for name in numbaSystemNames
+        if name in pythonisedExpressions
+    ]
+    ## The potential's mass matrices, which are in the hoisted coefficients with --bHoist
+    massMatrixEntries, massMatrixShape = tensorEntries(
+        pythonisedExpressions.get(
+            "hoistedScalarMassMatrices", pythonisedExpressions["scalarMassMatrices"]
+        ),
+        allSymbols,
+        {"log": "cmath.log", "sqrt": "cmath.sqrt"},
+    )
+
+    source = Environment().from_string(dedent("""\
+        import cmath
+        import math
+        import numpy as np
+        from numba import njit
+        {% for system in systems %}
+
+        @njit("complex128[::1](complex128[::1])", cache=True)
+        def _{{ system.name }}(params):
+        {%- for index in system.indices %}
+            p{{ index }} = params[{{ index }}]
+        {%- endfor %}
+        {%- for identifier, expression in system.temporaries %}
+            {{ identifier }} = {{ expression }}
+        {%- endfor %}
+            out = np.empty({{ system.expressions | length }}, dtype=np.complex128)
+        {%- for expression in system.expressions %}
+            out[{{ loop.index0 }}] = {{ expression }}
+        {%- endfor %}
+            return out
+
+
+        def {{ system.name }}(params):
+            return _{{ system.name }}(np.ascontiguousarray(params, dtype=np.complex128))
+        {% endfor %}
+
+        @njit("void(complex128[::1], float64[:, :, ::1])", cache=True)
+        def _scalarMassMatrices(p, matrices):
+        {%- for index, expression in massMatrixEntries %}
+            matrices[{{ index | join(", ") }}] = ({{ expression }}).real
+        {%- endfor %}
+
+
+        @njit("float64[:, :, ::1](complex128[::1], float64)", cache=True)
+        def _scaledScalarMassMatrices(params, T):
+            matrices = np.zeros({{ massMatrixShape }})
+            _scalarMassMatrices(params, matrices)
+            matrices /= T**2
+            return matrices
+
+
+        def scaledScalarMassMatrices(params, T):
+            return _scaledScalarMassMatrices(np.ascontiguousarray(params, dtype=np.complex128), T)
+
+
+        @njit("Tuple((float64[:, ::1], float64[:, :, ::1]))(complex128[::1], float64)", cache=True)
+        def _scalarEigenSystem(params, T):
+            matrices = _scaledScalarMassMatrices(params, T)
+            eigenValues = np.empty(matrices.shape[:2])
+            eigenVectors = np.empty(matrices.shape)
+            for idx in range(matrices.shape[0]):
+                eigenValues[idx], eigenVectors[idx] = np.linalg.eigh(matrices[idx])
+            return eigenValues * T**2, eigenVectors
+
+
+        def scalarEigenSystem(params, T):
+            return _scalarEigenSystem(np.ascontiguousarray(params, dtype=np.complex128), T)
+        """)).render(
+            systems=systems,
+            massMatrixEntries=massMatrixEntries,
+            massMatrixShape=massMatrixShape,
+        )
+
+    moduleFile = Path(moduleFile)
+    if not moduleFile.exists() or moduleFile.read_text() != source:
+        moduleFile.parent.mkdir(parents=True, exist_ok=True)
+        moduleFile.write_text(source)
+
+    return moduleFile
+
+
+def import_numba_module(moduleFile):
+    """Import the generated module, importing compiles every function
+    (or loads it from numba's cache) so pool workers inherit compiled code.
+    The module has to be in sys.modules for numba to load its cache"""
+    moduleName = f"bloopNumba_{Path(moduleFile).stem}"
+    spec = spec_from_file_location(moduleName, moduleFile)
+    module = module_from_spec(spec)
+    sys.modules[moduleName] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def numbaniseSystem(name, system):
+    ## Complex arithmetic throughout, like the python evaluator
+    expressions = [expression["expression"] for expression in system["expressions"]]
+    if any(re.search(r"[<>]", expression) for expression in expressions):
+        raise ValueError(f"{name} compares values, which numba can't do in complex arithmetic")
+
+    paramsPattern = re.compile(r"params\[(\d+)\]")
+
+    def numbanise(expression):
+        expression = paramsPattern.sub(r"p\1", expression)
+        expression = re.sub(r"\blog\(", "cmath.log(", expression)
+        return re.sub(r"\bsqrt\(", "cmath.sqrt(", expression)
+
+    temporaries = [
+        (temporary["identifier"], temporary["expression"])
+        for temporary in system.get("temporaries", [])
+    ]
+
+    return {
+        "name": name,
+        "indices": sorted(
+            {
+                int(index)
+                for expression in expressions + [temp[1] for temp in temporaries]
+                for index in paramsPattern.findall(expression)
+            }
+        ),
+        "temporaries": [
+            (identifier, numbanise(expression)) for identifier, expression in temporaries
+        ],
+        "expressions": [numbanise(expression) for expression in expressions],
+    }
+
+
+from unittest import TestCase
+
+
+class NumbaModuleUnitTests(TestCase):
+    def test_generate_numba_module(self):
+        from tempfile import TemporaryDirectory
+        import numpy as np
+        from Bloop.ParsedExpression import ParsedExpressionSystemArray
+
+        allSymbols = ["a", "b", "c", "d", "m"]
+        pythonisedExpressions = {
+            "vectorMassesSquared": {
+                "expressions": [
+                    {"identifier": "c", "expression": "sqrt(params[0]) + log(params[1])", "symbols": ["a", "b"]},
+                    {"identifier": "d", "expression": "params[0]**(3/2) * params[1] - 2", "symbols": ["a", "b"]},
+                ],
+            },
+            "bounded": {
+                "expressions": [
+                    {"identifier": "d", "expression": "params[0] > 0", "symbols": ["a"]},
+                ],
+            },
+            "scalarMassMatrices": {
+                "expressions": [{"identifier": "m", "expression": "((a, b), (b, a))"}],
+            },
+        }
+        ## Negative, complex and positive params so branch cuts and imaginary parts are checked
+        paramsMatrix = np.array(
+            [[4, 9, 0, 0, 0], [-4, 2 + 1j, 0, 0, 0], [0.5 - 2j, -1, 0, 0, 0]], dtype=complex
+        )
+
+        with TemporaryDirectory() as directory:
+            module = import_numba_module(
+                generate_numba_module(pythonisedExpressions, Path(directory) / "modelNumba.py", allSymbols)
+            )
+
+            self.assertFalse(hasattr(module, "bounded"))
+            for name in numbaSystemNames:
+                if name not in pythonisedExpressions:
+                    continue
+                expressions = pythonisedExpressions[name]["expressions"]
+                reference = ParsedExpressionSystemArray(expressions, allSymbols, None)
+                numba = ParsedExpressionSystemArray(
+                    expressions, allSymbols, None, jitFunction=getattr(module, name)
+                )
+                for params in paramsMatrix:
+                    np.testing.assert_allclose(reference.evaluate(params), numba.evaluate(params))
+
+    def test_scalarEigenSystem(self):
+        from tempfile import TemporaryDirectory
+        import numpy as np
+        from Bloop.ParsedExpression import ParsedExpressionSystemArray, indexSymbols
+
+        allSymbols = ["a", "b", "m"]
+        expressions = [
+            {"identifier": "m", "expression": "((a, sqrt(b)), (sqrt(b), 2*a - b))", "symbols": ["a", "b"]},
+            {"identifier": "m", "expression": "((log(b), a*b), (a*b, -a))", "symbols": ["a", "b"]},
+        ]
+        params, T = np.array([1.5, 3, 0], dtype=complex), 2.5
+
+        with TemporaryDirectory() as directory:
+            module = import_numba_module(
+                generate_numba_module(
+                    {"scalarMassMatrices": {"expressions": expressions}},
+                    Path(directory) / "modelNumba.py",
+                    allSymbols,
+                )
+            )
+            matrices = module.scaledScalarMassMatrices(params, T)
+            eigenValues, eigenVectors = module.scalarEigenSystem(params, T)
+
+        ## The python evaluator's matrices, scaled and diagonalised like the potential does
+        reference = np.array(
+            ParsedExpressionSystemArray(
+                indexSymbols(expressions, allSymbols), allSymbols, None
+            ).evaluateUnordered(params)
+        ).real / T**2
+        referenceValues, referenceVectors = np.linalg.eigh(reference)
+
+        np.testing.assert_allclose(reference, matrices)
+        np.testing.assert_allclose(referenceValues * T**2, eigenValues)
+        ## Eigenvectors are only defined up to sign
+        signs = np.sign(np.sum(eigenVectors * referenceVectors, axis=1, keepdims=True))
+        np.testing.assert_allclose(referenceVectors, eigenVectors * signs)
@@ -1,12 +1,36 @@
 import os
+import re
+import shutil
+from glob import glob
 from textwrap import dedent
 from jinja2 import Environment
 import numpy as np
 
 import Bloop.PythoniseMathematica as PythoniseMathematica
 
-def generate_veff_module(args, allSymbols):
-    
+## Loop orders are split into modules (translation units) of about this many
+## characters of expressions, so they compile in parallel with bounded memory each
+charactersPerModule = 100_000
+
+## Cython helper shared by the generated modules that take a params array
+complexArraySource = """\
+cdef complexArray(params):
+    ## Copying element wise is much quicker than numpy for lists of python numbers
+    if isinstance(params, np.ndarray):
+        return np.ascontiguousarray(params, dtype=np.complex128)
+
+    cdef Py_ssize_t i
+    cdef double complex[::1] p = np.empty(len(params), dtype=np.complex128)
+    for i in range(len(params)):
+        p[i] = params[i]
+    return p
+"""
+
+def generate_veff_module(args, allSymbols, veffSystems=None):
+    """veffSystems optionally holds the pythonised (cse) system of each loop
+    order, if given the submodules are generated from it instead of the raw
+    Mathematica files"""
+
     parent_dir = os.path.dirname(os.getcwd())
     data_dir   = os.path.join(parent_dir, 'src', 'Bloop')
     module_dir = os.path.join(parent_dir, 'src', 'Bloop', 'Veff')
@@ -16,6 +40,13 @@ def generate_veff_module(args, allSymbols):
     if args.verbose:
         print("Generating Veff submodule")
     
+    ## Modules (and their generated c and build files) of a previous model, which may
+    ## have been split differently, are removed, compile_veff_submodule restores
+    ## compiled modules from its cache
+    for fileName in glob(os.path.join(module_dir, '*.pyx')) + glob(os.path.join(module_dir, '*.c')) + glob(os.path.join(module_dir, '*.so')) + glob(os.path.join(module_dir, 'veff.py')):
+        os.remove(fileName)
+    shutil.rmtree(os.path.join(module_dir, 'build'), ignore_errors=True)
+    
     loopOrder = args.loopOrder 
     
     veffFPs   = [args.loFile, args.nloFile]
@@ -24,19 +55,35 @@ def generate_veff_module(args, allSymbols):
     if loopOrder >1:
         veffFPs.append(args.nnloFile)
         veffNames.append("nnlo")
-        
+    
+    moduleNames = {}
     for idx, name in enumerate(veffNames):
-        generateVeffSubModule(
-            name, 
-            os.path.join(module_dir, f"{name}.pyx"), 
-            os.path.join(data_dir, veffFPs[idx]), 
-            allSymbols
-        )
+        if veffSystems:
+            opsAndExpressions, temporaries = cythoniseSystem(
+                veffSystems[idx], allSymbols
+            )
+        else:
+            opsAndExpressions = np.transpose(
+                mutliLineExpression(os.path.join(data_dir, veffFPs[idx]))
+            )
+            temporaries = []
+        
+        moduleNames[name] = []
+        for moduleName, moduleOpsAndExpressions, moduleTemporaries in splitModules(
+            name, opsAndExpressions, temporaries
+        ):
+            moduleNames[name].append(moduleName)
+            generateVeffSubModule(
+                moduleName, 
+                os.path.join(module_dir, f"{moduleName}.pyx"), 
+                moduleOpsAndExpressions, 
+                allSymbols,
+                moduleTemporaries,
+            )
     
     generateVeffModule(
-        os.path.join(module_dir, 'veff.py'), 
-        loopOrder, 
-        allSymbols
+        os.path.join(module_dir, 'veff.pyx'), 
+        moduleNames, 
     )
     
     #================================ init file ==============================#
@@ -45,138 +92,216 @@ def generate_veff_module(args, allSymbols):
     
     #=============================== setup file ==============================#
     with open(os.path.join(module_dir, 'setup.py'), 'w') as file:
-        file.writelines(Environment().from_string(dedent("""\
+        file.writelines(dedent("""\
             #!/usr/bin/env python3
             # -*- coding: utf-8 -*-
+            import os
+            import sys
+            from glob import glob
             from setuptools import setup, Extension
             from Cython.Build import cythonize
             
-            extensions = [Extension("lo", ["lo.pyx"])]
-            {% if args.loopOrder >= 1 %}
-            extensions.append(Extension("nlo", ["nlo.pyx"]))
-            {% endif %}
-            {% if args.loopOrder >= 2 %}
-            extensions.append(Extension("nnlo", ["nnlo.pyx"]))
-            {% endif %}
+            ## OpenMP for the batch kernels, Apple's clang doesn't ship it so they run serially there
+            openmp = [] if sys.platform == "darwin" else ["-fopenmp"]
+            ## Flags of the build profile (see compile_veff_module.buildProfiles)
+            flags = openmp + os.environ.get("VEFF_CFLAGS", "").split()
+            
+            ## compile_veff_submodule only asks for the modules that aren't in its cache
+            if "VEFF_MODULES" in os.environ:
+                names = os.environ["VEFF_MODULES"].split()
+            else:
+                names = [os.path.splitext(pyx)[0] for pyx in sorted(glob("*.pyx"))]
+            
+            extensions = [
+                Extension(name, [f"{name}.pyx"], extra_compile_args=flags, extra_link_args=flags)
+                for name in names
+            ]
             
             setup(
                 name="Veff_cython",
                 ext_modules=cythonize(
-                    extensions, compiler_directives={"language_level": "3"}
+                    extensions, 
+                    nthreads=int(os.environ.get("VEFF_THREADS", 1)),
+                    compiler_directives={"language_level": "3"},
                 ),
             )
             """
-        )).render(args = args))
+        ))
+
+
+def splitModules(name, opsAndExpressions, temporaries):
+    ## Splits the terms of a loop order into modules of about charactersPerModule
+    ## characters, each with the temporaries it uses. Small orders stay one module
+    chunks, chunk, length = [], [], 0
+    for op, term in opsAndExpressions:
+        if chunk and length + len(term) > charactersPerModule:
+            chunks.append(chunk)
+            chunk, length = [], 0
+        chunk.append((op, term))
+        length += len(term)
+    chunks.append(chunk)
+    
+    if len(chunks) == 1:
+        return [(name, chunks[0], temporaries)]
+    
+    return [
+        (f"{name}_{idx}", chunk, usedTemporaries(chunk, temporaries))
+        for idx, chunk in enumerate(chunks)
+    ]
+
+
+def usedTemporaries(opsAndExpressions, temporaries):
+    ## Temporaries (cse0, cse1, ...) can use earlier ones so go backwards
+    ## collecting everything the terms need
+    temporaryPattern = re.compile(r"\bcse\d+\b")
+    needed = set(temporaryPattern.findall(" ".join(term for _, term in opsAndExpressions)))
+    used = []
+    for identifier, expression in reversed(temporaries):
+        if identifier in needed:
+            used.append((identifier, expression))
+            needed |= set(temporaryPattern.findall(expression))
+    return used[::-1]
+
         
-def generateVeffModule(filename, loopOrder, allSymbols):
-    """Write a  function that imports veff submodules based on loopOrder,
-    returns the evaluated submodules as a tuple.
+def generateVeffModule(filename, moduleNames):
+    """Write a module that imports veff submodules (moduleNames maps each
+    loop order to the modules it is split into), Veff sums them at a point.
+    Also writes VeffBatch which sums the submodules for many points at once.
     """
     with open(filename, 'w') as file:
         file.write(Environment().from_string(dedent(
         """\
-        from .lo import lo
-        from .nlo import nlo
-        {%- if loopOrder > 1 %}
-        from .nnlo import nnlo
-        {%- endif %}
+        import numpy as np
+        {%- for names in moduleNames.values() %}
+        {%- for name in names %}
+        from .{{ name }} import {{ name }}, {{ name }}Batch
+        {%- endfor %}
+        {%- endfor %}
+        
+        
+        {{ complexArraySource }}
         
-        def Veff(
-        {%- for symbol in allSymbols %}
-            {{ symbol }} = 1,
+        def VeffBatch(params):
+            ## Rows of params are points, columns are indexed like allSymbols
+            params = np.ascontiguousarray(params, dtype=np.complex128)
+            out = np.zeros(len(params), dtype=np.complex128)
+        {%- for names in moduleNames.values() %}
+        {%- for name in names %}
+            {{ name }}Batch(params, out)
         {%- endfor %}
-            ):
-            val_lo = lo(
-        {%- for symbol in allSymbols %}
-                {{ symbol }},
         {%- endfor %}
-            )
-            
-            val_nlo = nlo(
-        {%- for symbol in allSymbols %}
-                {{ symbol }},
+            return out
+        
+        
+        def Veff(params):
+            ## Every loop order summed, params (real or complex) is indexed like allSymbols
+            cdef const double complex[::1] buffer = complexArray(params)
+            return (
+                0
+        {%- for names in moduleNames.values() %}
+        {%- for name in names %}
+                + {{ name }}(buffer)
         {%- endfor %}
-            )
-            
-        {%- if loopOrder > 1 %}
-            val_nnlo = nnlo(
-        {%- for symbol in allSymbols %}
-                {{ symbol }},
         {%- endfor %}
             )
-            return (val_lo, val_nlo, val_nnlo)
-        
-        {%- else %}
-            return (val_lo, val_nlo)
-        {%- endif %}
-        """)).render(loopOrder=loopOrder, allSymbols=allSymbols))
+        """)).render(moduleNames=moduleNames, complexArraySource=complexArraySource))
      
-def generateVeffSubModule(name, moduleName, veffFp, allSymbols):
+def generateVeffSubModule(name, moduleName, opsAndExpressions, allSymbols, temporaries):
     # Creates a cython module with that computes an order of Veff
     with open(moduleName, 'w') as file:
     
         file.write(Environment().from_string(dedent("""\
-            #cython: cdivision=False
+            #cython: cdivision=True, boundscheck=False, wraparound=False
+            from cython.parallel cimport prange
             from libc.complex cimport csqrt
             from libc.complex cimport clog
             
-            cpdef double complex {{ name }}(
-            {%- for symbol in allSymbols %}
-                double complex {{ symbol }},
-            {%- endfor %}
-                ):
-                ## Calling _name decreases compile time, maybe increases perfomance
-                return _{{ name }}(
-            {%- for symbol in allSymbols %}
-                    {{ symbol }},
-            {%- endfor %}
-                )
+            cpdef double complex {{ name }}(const double complex[::1] params):
+                ## params is indexed like allSymbols
+                return _{{ name }}(&params[0])
             
-            cdef double complex _{{ name }}(
+            def {{ name }}Batch(const double complex[:, ::1] params, double complex[::1] out):
+                ## Adds {{ name }} at each row of params (indexed like allSymbols) to out,
+                ## rows are spread over threads with OpenMP
+                cdef Py_ssize_t row
+                for row in prange(params.shape[0], nogil=True):
+                    out[row] += _{{ name }}(&params[row, 0])
+            
+            ## noexcept so the batch kernel never checks for (i.e. takes the GIL for) errors,
+            ## division can't raise as it's C division of floats (see floatLiterals)
+            cdef double complex _{{ name }}(const double complex* params) noexcept nogil:
+                cdef double complex a = 0.0
             {%- for symbol in allSymbols %}
-                double complex {{ symbol }},
+                cdef double complex {{ symbol }} = params[{{ loop.index0 }}]
+            {%- endfor %}
+            {%- for temporary in temporaries %}
+                cdef double complex {{ temporary[0] }} = {{ temporary[1] }}
             {%- endfor %}
-                ):
-                cdef double complex a = 0.0
             {%- for op, term in opsAndExpressions %}
                 a {{ op }} {{ term }}
             {%- endfor %}
                 return a
-            """)).render(name=name, allSymbols=allSymbols, opsAndExpressions=np.transpose(mutliLineExpression(veffFp))))
+            """)).render(
+                name=name, 
+                allSymbols=allSymbols, 
+                opsAndExpressions=[(op, floatLiterals(term)) for op, term in opsAndExpressions],
+                temporaries=[
+                    (identifier, floatLiterals(expression))
+                    for identifier, expression in temporaries
+                ],
+            ))
+
+
+## Integers that aren't part of a name, a float or an exponent (a**2 stays an
+## integer power, which is quicker)
+integerPattern = re.compile(r"(?<![\w.])(?<!\*\*)(?<!\d[eE][+-])(\d+)(?![\w.])")
 
 
+def floatLiterals(expression):
+    ## Every division in the submodules is then of floats, which in C (cdivision)
+    ## gives inf or nan rather than raising
+    return integerPattern.sub(r"\1.0", expression)
+
+
+def cythoniseSystem(veffSystem, allSymbols):
+    ## Converts a pythonised array system (params[idx], log, sqrt) back to the
+    ## named double complex arguments and libc functions used by the submodules
+    def cythonise(expression):
+        expression = re.sub(
+            r"params\[(\d+)\]", lambda match: allSymbols[int(match.group(1))], expression
+        )
+        expression = re.sub(r"\blog\(", "clog(", expression)
+        return re.sub(r"\bsqrt\(", "csqrt(", expression)
+    
+    opsAndExpressions = [
+        ("+=", cythonise(expression["expression"])) 
+        for expression in veffSystem["expressions"]
+    ]
+    temporaries = [
+        (temporary["identifier"], cythonise(temporary["expression"])) 
+        for temporary in veffSystem.get("temporaries", [])
+    ]
+    return opsAndExpressions, temporaries
+
 
 def mutliLineExpression(filePointer):
     ## Takes an expressions and breaks it down into a mutli line expression
     ## (Cython seems to struggle with the one line NNLO veff)
-    
+    ## Terms are split off with the same (streaming) splitting used when pythonising
     with open(filePointer, 'r') as file:
-        veff = file.read()
+        terms = list(PythoniseMathematica.streamSummands(file, 0))
     
     operations = ["+="]
-    expressions = []
-    
-    netBrackets = 0
-    start = 0
-    
-    for i, char in enumerate(veff):
-        if char == '(':
-            netBrackets += 1
-        elif char == ')':
-            netBrackets -= 1
-        if char == ' ' and netBrackets == 0:
-            ##+1 to catch space
-            line = veff[start:i+1]
-            if line in ["+ ", "- "]:
-                operations.append("+=" if line == "+ " else "-=")
-            else:
-                expressions.append(convert_to_cython_syntax(line))
-            start = i + 1
+    expressions = [convert_to_cython_syntax(terms[0])]
     
-    # Any remaining characters should just be expressions
-    if start < len(veff):
-        line = veff[start:]
-        expressions.append(convert_to_cython_syntax(line))
+    for term in terms[1:]:
+        term = term.strip()
+        if term[0] in "+-":
+            operations.append("+=" if term[0] == "+" else "-=")
+            term = term[1:]
+        else:
+            operations.append("+=")
+        expressions.append(convert_to_cython_syntax(term.strip()))
     return operations, expressions
     
 def convert_to_cython_syntax(term):
@@ -186,4 +311,74 @@ def convert_to_cython_syntax(term):
     term = term.replace(']', ')')
     term = term.replace('^', '**')
     term = PythoniseMathematica.replaceSymbolsConst(term)
-    return PythoniseMathematica.replaceGreekSymbols(term)
\ No newline at end of file
+    return PythoniseMathematica.replaceGreekSymbols(term)
+
+from unittest import TestCase
+
+
+class VeffModuleUnitTests(TestCase):
+    def test_floatLiterals(self):
+        reference = "1.0/2.0*a**2 + cse12*lam1/(3.0*b) - 2.5*c + 1e-5*d**(1.0/2.0)"
+
+        self.assertEqual(
+            reference, floatLiterals("1/2*a**2 + cse12*lam1/(3*b) - 2.5*c + 1e-5*d**(1/2)")
+        )
+
+    def test_generateVeffSubModule(self):
+        from tempfile import TemporaryDirectory
+
+        with TemporaryDirectory() as directory:
+            moduleFile = os.path.join(directory, "lo.pyx")
+            generateVeffSubModule("lo", moduleFile, [("+=", "a/2"), ("-=", "b**2")], ["a", "b"], [])
+            with open(moduleFile) as file:
+                source = file.read()
+
+        ## The batch kernel mustn't take the GIL to check for errors after each row
+        self.assertIn("cdivision=True", source)
+        self.assertIn("_lo(const double complex* params) noexcept nogil:", source)
+        self.assertNotIn("except *", source)
+        self.assertIn("a += a/2.0", source)
+
+    def test_splitModules(self):
+        import sys
+        from unittest.mock import patch
+
+        opsAndExpressions = [("+=", "a*cse1"), ("-=", "b**2"), ("+=", "cse2/a"), ("-=", "c + cse0")]
+        temporaries = [("cse0", "a + b"), ("cse1", "cse0*c"), ("cse2", "b - 1"), ("cse3", "c*c")]
+
+        def evaluate(modules):
+            ## Sum of the modules' terms, each with only its own temporaries defined
+            total = 0
+            for _, moduleOpsAndExpressions, moduleTemporaries in modules:
+                namespace = {"a": 2.0, "b": 3.0, "c": 5.0}
+                for identifier, expression in moduleTemporaries:
+                    namespace[identifier] = eval(expression, namespace)
+                for op, term in moduleOpsAndExpressions:
+                    total += eval(term, namespace) * (1 if op == "+=" else -1)
+            return total
+
+        unsplit = splitModules("lo", opsAndExpressions, temporaries)
+        self.assertEqual([("lo", opsAndExpressions, temporaries)], unsplit)
+
+        with patch.object(sys.modules[__name__], "charactersPerModule", 8):
+            modules = splitModules("lo", opsAndExpressions, temporaries)
+
+        self.assertEqual(["lo_0", "lo_1", "lo_2", "lo_3"], [name for name, _, _ in modules])
+        self.assertEqual(opsAndExpressions, [term for _, terms, _ in modules for term in terms])
+        ## Each module declares exactly the temporaries its terms (and those temporaries) use
+        self.assertEqual(
+            [["cse0", "cse1"], [], ["cse2"], ["cse0"]],
+            [[identifier for identifier, _ in used] for _, _, used in modules],
+        )
+        self.assertEqual(evaluate(unsplit), evaluate(modules))
+
+    def test_usedTemporaries(self):
+        temporaries = [("cse0", "a"), ("cse1", "cse0*b"), ("cse2", "cse1 + 1"), ("cse10", "c")]
+
+        self.assertEqual(
+            temporaries[:3], usedTemporaries([("+=", "cse2**2"), ("-=", "a")], temporaries)
+        )
+        ## cse1 mustn't match cse10 (or the other way round)
+        self.assertEqual(
+            [("cse10", "c")], usedTemporaries([("+=", "2*cse10")], temporaries)
+        )